@@ -1,10 +1,137 @@
 from fractions import Fraction
-from utils import Operator
+from utils import Operator, compile_effect
 from math import comb
 from functools import lru_cache
 
+NO_CLIMAX = Fraction(0)
+# Version of the transition kernels, bump it whenever a kernel change can change a result,
+# the results saved on disk (atlases, Markov chains) of another version are not used
+KERNEL_VERSION = 2
+# Closed-form kernels, can be turned off to check them against the step by step kernels
+FAST_KERNELS = True
+
+def set_fast_kernels(enabled):
+    global FAST_KERNELS
+    FAST_KERNELS = enabled
+    Player.take_damage.cache_clear()
+    Player.take_moka.cache_clear()
+    Player.michiru.cache_clear()
+    Player.run_effect.cache_clear()
+
+def case_comb(n, c, a, d):
+    return comb(c, d) * comb(n-c, a-d)
+
+def add_outcome(outcomes, key, weight):
+    '''
+    Merge a (state key, weight) outcome into a hashed outcome table
+    '''
+    if key in outcomes:
+        outcomes[key] += weight
+    else:
+        outcomes[key] = weight
+
+def level_up_key(key):
+    '''
+    key: (deck, waiting_room, level, clock, top_non_climax), see Player.key
+    Return the key after the level up check
+    '''
+    deck, waiting_room, level, clock, _ = key
+    if clock[0] < 7:
+        return key
+    
+    up = clock[0] // 7
+    rest = clock[0] % 7
+    return (
+        deck,
+        (waiting_room[0] + clock[0] - rest, waiting_room[1] + clock[1]),
+        (level[0] + up, level[1]),
+        (rest, 0),
+        0,
+    )
+
+def refresh_key(key):
+    '''
+    Refresh the deck of the state key, the top card of the new deck is put to clock
+    Return: list of (state key, probability)
+    '''
+    deck, waiting_room, level, clock, _ = key
+    if deck[0] != 0:
+        raise ValueError("Deck is not empty, can't refresh deck")
+    
+    new_deck = waiting_room
+    if new_deck[0] == 0:
+        raise ValueError("No cards in waiting room or deck")
+    
+    outcomes = []
+    # Since the deck is shuffled, the top card probability is reset
+    if new_deck[1] > 0:
+        outcomes.append((level_up_key((
+            (new_deck[0] - 1, new_deck[1] - 1),
+            (0, 0),
+            level,
+            (clock[0] + 1, clock[1] + 1),
+            0,
+        )), Fraction(new_deck[1], new_deck[0])))
+    
+    if new_deck[0] > new_deck[1]:
+        outcomes.append((level_up_key((
+            (new_deck[0] - 1, new_deck[1]),
+            (0, 0),
+            level,
+            (clock[0] + 1, clock[1]),
+            0,
+        )), Fraction(new_deck[0] - new_deck[1], new_deck[0])))
+    
+    return outcomes
+
+def refresh_outcomes(outcomes):
+    '''
+    Refresh every outcome whose deck is empty, and merge the results
+    outcomes: dict(state key: weight)
+    Return: tuple of (state key, weight), immutable so that the cached kernels can be shared
+    '''
+    final_outcomes = {}
+    for key, weight in outcomes.items():
+        if key[0][0] == 0:
+            for new_key, prob in refresh_key(key):
+                add_outcome(final_outcomes, new_key, weight * prob)
+        else:
+            add_outcome(final_outcomes, key, weight)
+    return tuple(final_outcomes.items())
+
+def refresh_until_drawable(key):
+    '''
+    Refresh the deck of the state key until it has a card to draw, the card put to clock
+    can level up and send the clock back to the waiting room, then the new deck can be empty again
+    Return: list of (state key, probability)
+    '''
+    outcomes = {key: Fraction(1)}
+    while any(key[0][0] == 0 for key in outcomes):
+        next_outcomes = {}
+        for key, weight in outcomes.items():
+            if key[0][0] == 0:
+                for new_key, prob in refresh_key(key):
+                    add_outcome(next_outcomes, new_key, weight * prob)
+            else:
+                add_outcome(next_outcomes, key, weight)
+        outcomes = next_outcomes
+    return list(outcomes.items())
+
+def draw_card(deck, top_non_climax):
+    '''
+    Reveal the top card of the deck, the first top_non_climax cards are known non-climax cards
+    Return: (climax probability, number of known non-climax cards left on top)
+    '''
+    if deck[0] == 0:
+        raise ValueError("Deck is empty, can't get climax probability")
+    
+    if top_non_climax > 0:
+        return NO_CLIMAX, top_non_climax - 1
+    else:
+        return Fraction(deck[1], deck[0]), 0
+
 class Player:
-    def __init__(self, deck, waiting_room, level, clock, probability=Fraction(1), top_climax_prob=()):
+    def __init__(self, deck, waiting_room, level, clock, probability=Fraction(1), top_non_climax=0):
         '''
         deck: tuple, (Number of cards, Number of climaxes)
         waiting_room: tuple, (Number of cards, Number of climaxes)
@@ -12,22 +139,36 @@ class Player:
         clock: tuple, (Number of cards, Number of climaxes)
         stock: tuple, (Number of cards, Number of climaxes)
         probability: Probability of reaching this state
-        top_climax_prob: List of probabilities of the top cards being climaxes
+        top_non_climax: Number of known non-climax cards on top of the deck
+        A Player is never modified after it is built, every transition returns new states,
+        so the cached transitions can be shared between threads
         '''
         self.deck = deck
         self.waiting_room = waiting_room
         self.clock = clock
         self.level = level
         self.probability = probability
-        self.top_climax_prob = top_climax_prob
+        self.top_non_climax = top_non_climax
+    
+    @classmethod
+    def from_key(cls, key, probability=Fraction(1)):
+        deck, waiting_room, level, clock, top_non_climax = key
+        return cls(deck, waiting_room, level, clock, probability, top_non_climax)
+    
+    def key(self):
+        '''
+        Compact hashable form of the state, without the probability
+        '''
+        return (self.deck, self.waiting_room, self.level, self.clock, self.top_non_climax)
     
     def copy(self):
-        return Player(self.deck, self.waiting_room, self.level, self.clock, self.probability, self.top_climax_prob)
+        return Player(self.deck, self.waiting_room, self.level, self.clock, self.probability, self.top_non_climax)
     
     # reload the equality operator
     def __eq__(self, other):
         '''
-        Check if two game states are equal, used for merging states in the tree
+        Check if two game states are equal, used as the key of the cached transitions.
+        The probability is left out, the transitions don't depend on it
         '''
         if not isinstance(other, Player):
             raise ValueError("Can only compare Player with Player")
@@ -36,11 +177,10 @@ class Player:
                self.waiting_room == other.waiting_room and \
                self.clock == other.clock and \
                self.level == other.level and \
-               self.probability == other.probability and \
-               self.top_climax_prob == other.top_climax_prob
+               self.top_non_climax == other.top_non_climax
     
     def __hash__(self):
-        return hash((self.deck, self.waiting_room, self.level, self.clock, self.probability, self.top_climax_prob))
+        return hash((self.deck, self.waiting_room, self.level, self.clock, self.top_non_climax))
     
     def same_state(self, other):
         '''
@@ -53,7 +193,7 @@ class Player:
                self.waiting_room == other.waiting_room and \
                self.level == other.level and \
                self.clock == other.clock and \
-               self.top_climax_prob == other.top_climax_prob
+               self.top_non_climax == other.top_non_climax
             
     def is_terminal(self):
         return self.level[0] >= 4
@@ -62,186 +202,142 @@ class Player:
         if self.clock[0] < 7:
             return self
         
-        up = self.clock[0] // 7
-        rest = self.clock[0] % 7
-        
-        return Player(
-            self.deck,
-            (self.waiting_room[0] + self.clock[0] - rest, self.waiting_room[1] + self.clock[1]),
-            (self.level[0] + up, self.level[1]),
-            (rest, 0),
-            self.probability,
-        )
+        return Player.from_key(level_up_key(self.key()), self.probability)
         
     def refresh_deck(self):
-        if self.deck[0] != 0:
-            raise ValueError("Deck is not empty, can't refresh deck")
-        
-        new_deck = self.waiting_room
-        if new_deck[0] == 0:
-            raise ValueError("No cards in waiting room or deck")
-  
-        states = []
-        # Since the deck is shuffled, the top card probability is reset
-        climax_prob = Fraction(new_deck[1], new_deck[0])
-        non_climax_prob = Fraction(new_deck[0] - new_deck[1], new_deck[0])
-       
-        if climax_prob > 0:
-            climax_game_state = Player(
-                (new_deck[0] - 1, new_deck[1] - 1),
-                (0, 0),
-                self.level,
-                (self.clock[0] + 1, self.clock[1] + 1),
-                self.probability * climax_prob,
-            )
-            climax_game_state = climax_game_state.level_up_check()
-            states.append(climax_game_state)
-        
-        if non_climax_prob > 0:
-            non_climax_game_state = Player(
-                (new_deck[0] - 1, new_deck[1]),
-                (0, 0),
-                self.level,
-                (self.clock[0] + 1, self.clock[1]),
-                self.probability * non_climax_prob,
-            )
-            non_climax_game_state = non_climax_game_state.level_up_check()
-            states.append(non_climax_game_state)
-        
-        return states
+        return [Player.from_key(key, self.probability * prob) for key, prob in refresh_key(self.key())]
 
-    def inplace_shuffle_deck(self):
-        if self.top_climax_prob:
-            self.top_climax_prob = ()
+    def shuffle_deck(self):
+        return Player(self.deck, self.waiting_room, self.level, self.clock, self.probability, 0)
         
     def hp(self):
         return self.level[0] * 7 + self.clock[0]
     
     def get_climax_prob(self):
-        if self.deck[0] == 0:
-            raise ValueError("Deck is empty, can't get climax probability")
-        
-        if self.top_climax_prob:
-            return self.top_climax_prob[0], Player(self.deck, self.waiting_room, self.level, self.clock, self.probability, self.top_climax_prob[1:])
-        else:
-            return Fraction(self.deck[1], self.deck[0]), self
+        climax_prob, top_non_climax = draw_card(self.deck, self.top_non_climax)
+        if top_non_climax == self.top_non_climax:
+            return climax_prob, self
+        return climax_prob, Player(self.deck, self.waiting_room, self.level, self.clock, self.probability, top_non_climax)
     
     @lru_cache(maxsize=None)
     def take_damage(self, damage):
+        '''
+        Check damage cards one by one, the damage is cancelled by the first climax
+        During the process, the deck is reshuffled if it's empty
+        Return: list of (state key, probability)
+        '''
         if damage <= 0:
             raise ValueError("Damage must be positive")
         
-        def take_damage_helper(state, damage, checked_num, terminal_states):
-            if state.is_terminal():
-                terminal_states.append(state)
-                return
-            
-            if state.deck[0] == 0:
-                middle_states = state.refresh_deck()
-                for middle_state in middle_states:
-                    take_damage_helper(middle_state, damage, checked_num, terminal_states)
-                return
+        def take_damage_helper(key, damage, terminal_states):
+            # Cards being checked stay outside the deck and the waiting room
+            # until the check is over, so they are part of the frontier key
+            frontier = {(key, 0): Fraction(1)}
+            while frontier:
+                next_frontier = {}
+                for (key, checked_num), weight in frontier.items():
+                    deck, waiting_room, level, clock, top_non_climax = key
+                    if level[0] >= 4:
+                        add_outcome(terminal_states, key, weight)
+                        continue
                     
-            climax_prob, state = state.get_climax_prob()
-            non_climax_prob = 1 - climax_prob
-            
-            new_deck = (state.deck[0] - 1, state.deck[1] - 1)
-            new_non_climax_deck = (state.deck[0] - 1, state.deck[1])
+                    if deck[0] == 0:
+                        for new_key, prob in refresh_key(key):
+                            add_outcome(next_frontier, (new_key, checked_num), weight * prob)
+                        continue
+                    
+                    climax_prob, top_non_climax = draw_card(deck, top_non_climax)
+                    non_climax_prob = 1 - climax_prob
+                    
+                    if climax_prob > 0:
+                        # The damage is cancelled
+                        add_outcome(terminal_states, (
+                            (deck[0] - 1, deck[1] - 1),
+                            (waiting_room[0] + checked_num + 1, waiting_room[1] + 1),
+                            level,
+                            clock,
+                            top_non_climax,
+                        ), weight * climax_prob)
+                    
+                    if non_climax_prob > 0:
+                        is_damage_done = checked_num + 1 == damage
+                        next_key = level_up_key((
+                            (deck[0] - 1, deck[1]),
+                            waiting_room,
+                            level,
+                            (clock[0] + damage, clock[1]) if is_damage_done else clock,
+                            top_non_climax,
+                        ))
+                        if is_damage_done:
+                            add_outcome(terminal_states, next_key, weight * non_climax_prob)
+                        else:
+                            add_outcome(next_frontier, (next_key, checked_num + 1), weight * non_climax_prob)
+                frontier = next_frontier
+        
+        def take_damage_helper_fast(key, damage, terminal_states):
+            '''
+            We don't consider refresh deck situation here, the damage check
+            stops at the first climax, so the cancel position is enough to
+            describe the outcome
+            '''
+            (deck_num, climax_num), waiting_room, level, clock, _ = key
+            non_climax_num = deck_num - climax_num
             
-            if climax_prob > 0:
-                # The damage is cancelled
-                terminal_states.append(Player(
-                    new_deck,
-                    (state.waiting_room[0] + checked_num + 1, state.waiting_room[1] + 1),
-                    state.level,
-                    state.clock,
-                    state.probability * climax_prob,
-                    state.top_climax_prob
-                ))
+            for checked_num in range(1, damage + 1):
+                # The first checked_num - 1 cards are not climax, the next one is
+                cases = comb(non_climax_num, checked_num - 1) * climax_num
+                if cases == 0:
+                    break
+                terminal_states[(
+                    (deck_num - checked_num, climax_num - 1),
+                    (waiting_room[0] + checked_num, waiting_room[1] + 1),
+                    level,
+                    clock,
+                    0,
+                )] = Fraction(cases, comb(deck_num, checked_num - 1) * (deck_num - checked_num + 1))
             
-            if non_climax_prob > 0:
-                is_damage_done = checked_num + 1 == damage
-                next_state = Player(
-                        new_non_climax_deck,
-                        state.waiting_room,
-                        state.level,
-                        (state.clock[0] + damage, state.clock[1]) if is_damage_done else state.clock,
-                        state.probability * non_climax_prob,
-                        state.top_climax_prob
-                    )
-                next_state = next_state.level_up_check()
-                    
-                if is_damage_done:
-                    terminal_states.append(next_state)
-                else:
-                    take_damage_helper(next_state, damage, checked_num + 1, terminal_states)
+            cases = comb(non_climax_num, damage)
+            if cases > 0:
+                terminal_states[level_up_key((
+                    (deck_num - damage, climax_num),
+                    waiting_room,
+                    level,
+                    (clock[0] + damage, clock[1]),
+                    0,
+                ))] = Fraction(cases, comb(deck_num, damage))
         
-        terminal_states = []
-        take_damage_helper(self, damage, 0, terminal_states)
-        final_states = []
-        for state in terminal_states:
-            if state.deck[0] == 0:
-                final_states.extend(state.refresh_deck())
-            else:
-                final_states.append(state)
-        return final_states
+        terminal_states = {}
+        if FAST_KERNELS and damage <= self.deck[0] and self.top_non_climax == 0 and self.clock[0] < 7 and not self.is_terminal():
+            take_damage_helper_fast(self.key(), damage, terminal_states)
+        else:
+            take_damage_helper(self.key(), damage, terminal_states)
+        return refresh_outcomes(terminal_states)
     
     @lru_cache(maxsize=None)
     def take_moka(self, moka_num):
         '''
         Draw moka_num cards from the deck, put the climax cards into the waiting room, and the rest back to the deck
         During the process, the deck won't be reshuffled even if it's empty
-        Return: list of Player
+        The known non-climax cards on top are looked first, the number of climax cards among
+        the other looked cards is hypergeometric, all the looked non-climax cards become known
+        Return: list of (state key, probability)
         '''
-        def take_moka_helper(state, left_moka_num, non_climax_num, terminal_states):
-            if left_moka_num == 0:
-                tmp = []
-                if state.deck[0] == 0:
-                    tmp.extend(state.refresh_deck())
-                else:
-                    state.top_climax_prob = tuple([Fraction(0)] * non_climax_num)
-                    tmp.append(state)
-                
-                for s in tmp:
-                    found = False
-                    for t in terminal_states:
-                        if s.same_state(t):
-                            t.probability += s.probability
-                            found = True
-                            break
-                    if not found:
-                        terminal_states.append(s)
-                return
-            
-            climax_prob, state = state.get_climax_prob()
-            if state == state:
-                climax_prob = Fraction(state.deck[1], state.deck[0] - non_climax_num)
-            non_climax_prob = 1 - climax_prob
-            
-            if climax_prob > 0:
-                take_moka_helper(Player(
-                    (state.deck[0] - 1, state.deck[1] - 1),
-                    (state.waiting_room[0] + 1, state.waiting_room[1] + 1),
-                    state.level,
-                    state.clock,
-                    state.probability * climax_prob,
-                    state.top_climax_prob
-                ), left_moka_num - 1, non_climax_num, terminal_states)
-            
-            if non_climax_prob > 0:
-                take_moka_helper(Player(
-                    state.deck,
-                    state.waiting_room,
-                    state.level,
-                    state.clock,
-                    state.probability * non_climax_prob,
-                    state.top_climax_prob
-                ), left_moka_num - 1, non_climax_num + 1, terminal_states)
-
-        terminal_states = []
-        moka_num = min(moka_num, self.deck[0])
-        take_moka_helper(self, moka_num, 0, terminal_states)
-        return terminal_states
+        deck, waiting_room, level, clock, top_non_climax = self.key()
+        moka_num = min(moka_num, deck[0])
+        unknown_num = moka_num - min(top_non_climax, moka_num)
+        unknown_deck_num = deck[0] - top_non_climax
+        tot_cases = comb(unknown_deck_num, unknown_num)
+        
+        terminal_states = {}
+        for num_climax in range(max(0, unknown_num - unknown_deck_num + deck[1]), min(deck[1], unknown_num) + 1):
+            terminal_states[(
+                (deck[0] - num_climax, deck[1] - num_climax),
+                (waiting_room[0] + num_climax, waiting_room[1] + num_climax),
+                level,
+                clock,
+                max(top_non_climax, moka_num - num_climax) if deck[0] != num_climax else 0,
+            )] = Fraction(case_comb(unknown_deck_num, deck[1], unknown_num, num_climax), tot_cases)
+        return refresh_outcomes(terminal_states)
     
     @lru_cache(maxsize=None)
     def michiru(self, michiru_num):
@@ -249,97 +345,126 @@ class Player:
         Draw michiru_num cards from the deck, put them into waiting room,
         return how many climax cards are drawn
         During the process, the deck is reshuffled if it's empty
-        Retutrn: dict(num of climax cards: list of Player)
+        Retutrn: tuple of (num of climax cards, tuple of (state key, probability))
         '''
-        def case_comb(n, c, a, d):
-            return comb(c, d) * comb(n-c, a-d)
-        
-        def michiru_helper_fast(state, michiru_num, terminal_states):
+        def michiru_helper_fast(key, michiru_num, terminal_states):
             '''
             We don't consider refresh deck situation here
             '''
-            tot_cases = comb(state.deck[0], michiru_num)
+            deck, waiting_room, level, clock, top_non_climax = key
+            tot_cases = comb(deck[0], michiru_num)
             
-            for num_climax in range(max(0, michiru_num - state.deck[0] + state.deck[1]), min(state.deck[1], michiru_num) + 1):
-                new_player = Player(
-                    (state.deck[0] - michiru_num, state.deck[1] - num_climax),
-                    (state.waiting_room[0] + michiru_num, state.waiting_room[1] + num_climax),
-                    state.level,
-                    state.clock,
-                    state.probability * Fraction(case_comb(state.deck[0], state.deck[1], michiru_num, num_climax), tot_cases),
-                    state.top_climax_prob
-                )
-                
-                if new_player.deck[0] == 0:
-                    if num_climax not in terminal_states:
-                        terminal_states[num_climax] = new_player.refresh_deck()
-                    else:
-                        terminal_states[num_climax].extend(new_player.refresh_deck())
-                else:
-                    if num_climax not in terminal_states:
-                        terminal_states[num_climax] = []
-                    terminal_states[num_climax].append(new_player)
+            for num_climax in range(max(0, michiru_num - deck[0] + deck[1]), min(deck[1], michiru_num) + 1):
+                terminal_states[num_climax] = {(
+                    (deck[0] - michiru_num, deck[1] - num_climax),
+                    (waiting_room[0] + michiru_num, waiting_room[1] + num_climax),
+                    level,
+                    clock,
+                    top_non_climax,
+                ): Fraction(case_comb(deck[0], deck[1], michiru_num, num_climax), tot_cases)}
             
-        def michiru_helper(state, left_michiru_num, num_climax, terminal_states):
+        def michiru_helper(key, michiru_num, terminal_states):
             '''
-            Terminal states: dict(num of climax cards: list of Player)
+            Terminal states: dict(num of climax cards: dict(state key: probability))
             '''
-            if left_michiru_num == 0:
-                tmp = []
-                if state.deck[0] == 0:
-                    tmp.extend(state.refresh_deck())
-                else:
-                    tmp.append(state)
-                
-                for s in tmp:
-                    found = False
-                    if num_climax not in terminal_states:
-                        terminal_states[num_climax] = []
+            frontier = {(key, 0): Fraction(1)}
+            for _ in range(michiru_num):
+                next_frontier = {}
+                for (key, num_climax), weight in frontier.items():
+                    if key[0][0] == 0:
+                        branches = [(new_key, weight * prob) for new_key, prob in refresh_until_drawable(key)]
+                    else:
+                        branches = [(key, weight)]
+                    
+                    for key, weight in branches:
+                        deck, waiting_room, level, clock, top_non_climax = key
+                        climax_prob, top_non_climax = draw_card(deck, top_non_climax)
+                        non_climax_prob = 1 - climax_prob
                         
-                    for t in terminal_states[num_climax]:
-                        if s.same_state(t):
-                            t.probability += s.probability
-                            found = True
-                            break
-                    if not found:
-                        terminal_states[num_climax].append(s)
-                return
-            
-            if state.deck[0] == 0:
-                tmp = state.refresh_deck()
-                for s in tmp:
-                    michiru_helper(s, left_michiru_num, num_climax, terminal_states)
-                return
-            
-            climax_prob, state = state.get_climax_prob()
-            non_climax_prob = 1 - climax_prob
-            
-            if climax_prob > 0:
-                michiru_helper(Player(
-                    (state.deck[0] - 1, state.deck[1] - 1),
-                    (state.waiting_room[0] + 1, state.waiting_room[1] + 1),
-                    state.level,
-                    state.clock,
-                    state.probability * climax_prob,
-                    state.top_climax_prob
-                ), left_michiru_num - 1, num_climax + 1, terminal_states)
+                        if climax_prob > 0:
+                            add_outcome(next_frontier, ((
+                                (deck[0] - 1, deck[1] - 1),
+                                (waiting_room[0] + 1, waiting_room[1] + 1),
+                                level,
+                                clock,
+                                top_non_climax,
+                            ), num_climax + 1), weight * climax_prob)
+                        
+                        if non_climax_prob > 0:
+                            add_outcome(next_frontier, ((
+                                (deck[0] - 1, deck[1]),
+                                (waiting_room[0] + 1, waiting_room[1]),
+                                level,
+                                clock,
+                                top_non_climax,
+                            ), num_climax), weight * non_climax_prob)
+                frontier = next_frontier
             
-            if non_climax_prob > 0:
-                michiru_helper(Player(
-                    (state.deck[0] - 1, state.deck[1]),
-                    (state.waiting_room[0] + 1, state.waiting_room[1]),
-                    state.level,
-                    state.clock,
-                    state.probability * non_climax_prob,
-                    state.top_climax_prob
-                ), left_michiru_num - 1, num_climax, terminal_states)
+            for (key, num_climax), weight in frontier.items():
+                if num_climax not in terminal_states:
+                    terminal_states[num_climax] = {}
+                add_outcome(terminal_states[num_climax], key, weight)
             
         terminal_states = {}
-        if michiru_num <= self.deck[0] and self.top_climax_prob == ():
-            michiru_helper_fast(self, michiru_num, terminal_states)
+        if FAST_KERNELS and michiru_num <= self.deck[0] and self.top_non_climax == 0:
+            michiru_helper_fast(self.key(), michiru_num, terminal_states)
         else:
-            michiru_helper(self, michiru_num, 0, terminal_states)
-        return terminal_states
+            michiru_helper(self.key(), michiru_num, terminal_states)
+        return tuple((num_climax, refresh_outcomes(outcomes)) for num_climax, outcomes in terminal_states.items())
+    
+    @lru_cache(maxsize=None)
+    def mill_bottom(self, mill_num):
+        '''
+        Put mill_num cards from the bottom of the deck into the waiting room,
+        return how many climax cards are milled
+        The known non-climax cards are on top, so they are milled last
+        During the process, the deck is reshuffled if it's empty
+        Return: tuple of (num of climax cards, tuple of (state key, probability))
+        '''
+        # The number of cards left to mill is part of the frontier key
+        frontier = {(self.key(), 0, mill_num): Fraction(1)}
+        terminal_states = {}
+        while frontier:
+            next_frontier = {}
+            for (key, num_climax, left_num), weight in frontier.items():
+                if left_num == 0:
+                    if num_climax not in terminal_states:
+                        terminal_states[num_climax] = {}
+                    add_outcome(terminal_states[num_climax], key, weight)
+                    continue
+                
+                if key[0][0] == 0:
+                    branches = [(new_key, weight * prob) for new_key, prob in refresh_key(key)]
+                else:
+                    branches = [(key, weight)]
+                
+                for key, weight in branches:
+                    deck, waiting_room, level, clock, top_non_climax = key
+                    segment = min(left_num, deck[0])
+                    unknown_num = deck[0] - top_non_climax
+                    if segment > unknown_num:
+                        # Every unknown card and some of the known ones
+                        add_outcome(next_frontier, ((
+                            (deck[0] - segment, 0),
+                            (waiting_room[0] + segment, waiting_room[1] + deck[1]),
+                            level,
+                            clock,
+                            deck[0] - segment,
+                        ), num_climax + deck[1], left_num - segment), weight)
+                        continue
+                    
+                    tot_cases = comb(unknown_num, segment)
+                    for milled in range(max(0, segment - unknown_num + deck[1]), min(deck[1], segment) + 1):
+                        add_outcome(next_frontier, ((
+                            (deck[0] - segment, deck[1] - milled),
+                            (waiting_room[0] + segment, waiting_room[1] + milled),
+                            level,
+                            clock,
+                            top_non_climax,
+                        ), num_climax + milled, left_num - segment), weight * Fraction(case_comb(unknown_num, deck[1], segment, milled), tot_cases))
+            frontier = next_frontier
+        
+        return tuple((num_climax, refresh_outcomes(outcomes)) for num_climax, outcomes in terminal_states.items())
     
     @lru_cache(maxsize=None)
     def woody(self, woody_num):
@@ -349,85 +474,151 @@ class Player:
         During the process, the deck won't be reshuffled even if it's empty
         woody_num <= state.deck[0]
         We don't consider refresh deck situation here
+        Return: tuple of (num of climax cards, probability)
         '''
-        def case_comb(n, c, a, d):
-            return comb(c, d) * comb(n-c, a-d)
-        
         if woody_num <= 0:
             raise ValueError("Woody number must be positive")
         
         woody_num = min(woody_num, self.deck[0])
         terminal_probs = {}
         
-        if self.top_climax_prob == ():
+        if self.top_non_climax == 0:
             tmp_deck = self.deck
-        elif woody_num > len(self.top_climax_prob):
-            woody_num -= len(self.top_climax_prob)
-            tmp_deck = (self.deck[0] - len(self.top_climax_prob), self.deck[1])
-        elif woody_num <= len(self.top_climax_prob):
-            return {0:1}
+        elif woody_num > self.top_non_climax:
+            woody_num -= self.top_non_climax
+            tmp_deck = (self.deck[0] - self.top_non_climax, self.deck[1])
+        elif woody_num <= self.top_non_climax:
+            return ((0, Fraction(1)),)
         
         tot_cases = comb(tmp_deck[0], woody_num)
         for num_climax in range(max(0, woody_num - tmp_deck[0] + tmp_deck[1]), min(tmp_deck[1], woody_num) + 1):
             prob = Fraction(case_comb(tmp_deck[0], tmp_deck[1], woody_num, num_climax), tot_cases)
             terminal_probs[num_climax] = prob
 
-        return terminal_probs
+        return tuple(terminal_probs.items())
         
     def put_to_clock(self, damage):
         '''
         Put damage cards from the deck to the clock, return the new game states
         During the process, the deck is reshuffled if it's empty
-        Return: list of Player
+        Return: list of (state key, probability)
         '''
-        def put_to_clock_helper(state, left_damage, terminal_states):
-            if left_damage == 0:
-                tmp = []
-                if state.deck[0] == 0:
-                    tmp.extend(state.refresh_deck())
-                else:
-                    tmp.append(state)
-                
-                for s in tmp:
-                    found = False
-                    for t in terminal_states:
-                        if s.same_state(t):
-                            t.probability += s.probability
-                            found = True
-                            break
-                    if not found:
-                        terminal_states.append(s)
-                return
-            
-            climax_prob, state = state.get_climax_prob()
-            non_climax_prob = 1 - climax_prob
+        def put_to_clock_helper(key, damage, terminal_states):
+            frontier = {key: Fraction(1)}
+            for _ in range(damage):
+                next_frontier = {}
+                for key, weight in frontier.items():
+                    deck, waiting_room, level, clock, top_non_climax = key
+                    climax_prob, top_non_climax = draw_card(deck, top_non_climax)
+                    non_climax_prob = 1 - climax_prob
+                    
+                    if climax_prob > 0:
+                        add_outcome(next_frontier, level_up_key((
+                            (deck[0] - 1, deck[1] - 1),
+                            waiting_room,
+                            level,
+                            (clock[0] + 1, clock[1] + 1),
+                            top_non_climax,
+                        )), weight * climax_prob)
+                    
+                    if non_climax_prob > 0:
+                        add_outcome(next_frontier, level_up_key((
+                            (deck[0] - 1, deck[1]),
+                            waiting_room,
+                            level,
+                            (clock[0] + 1, clock[1]),
+                            top_non_climax,
+                        )), weight * non_climax_prob)
+                frontier = next_frontier
             
-            if climax_prob > 0:
-                climax_state = Player(
-                    (state.deck[0] - 1, state.deck[1] - 1),
-                    state.waiting_room,
-                    state.level,
-                    (state.clock[0] + 1, state.clock[1] + 1),
-                    state.probability * climax_prob,
-                    state.top_climax_prob
-                )
-                climax_state = climax_state.level_up_check()
-                put_to_clock_helper(climax_state, left_damage - 1, terminal_states)
+            for key, weight in frontier.items():
+                add_outcome(terminal_states, key, weight)
+        
+        def put_to_clock_helper_fast(key, damage, terminal_states):
+            '''
+            We don't consider refresh deck situation here.
+            The cards are split into segments ending at each level up, the climax
+            count of every segment follows a hypergeometric distribution on the
+            remaining deck, so only the counts per segment matter
+            '''
+            frontier = {key: Fraction(1)}
+            clock_num = key[3][0]
+            left_damage = damage
+            while left_damage > 0:
+                segment = min(left_damage, 7 - clock_num)
+                next_frontier = {}
+                for key, weight in frontier.items():
+                    deck, waiting_room, level, clock, top_non_climax = key
+                    tot_cases = comb(deck[0], segment)
+                    for num_climax in range(max(0, segment - deck[0] + deck[1]), min(deck[1], segment) + 1):
+                        add_outcome(next_frontier, level_up_key((
+                            (deck[0] - segment, deck[1] - num_climax),
+                            waiting_room,
+                            level,
+                            (clock[0] + segment, clock[1] + num_climax),
+                            top_non_climax,
+                        )), weight * Fraction(case_comb(deck[0], deck[1], segment, num_climax), tot_cases))
+                frontier = next_frontier
+                clock_num = (clock_num + segment) % 7
+                left_damage -= segment
             
-            if non_climax_prob > 0:
-                non_climax_state = Player(
-                    (state.deck[0] - 1, state.deck[1]),
-                    state.waiting_room,
-                    state.level,
-                    (state.clock[0] + 1, state.clock[1]),
-                    state.probability * non_climax_prob,
-                    state.top_climax_prob
-                )
-                put_to_clock_helper(non_climax_state, left_damage - 1, terminal_states)
+            for key, weight in frontier.items():
+                add_outcome(terminal_states, key, weight)
         
-        terminal_states = []
-        put_to_clock_helper(self, damage, terminal_states)
-        return terminal_states
+        terminal_states = {}
+        if FAST_KERNELS and damage <= self.deck[0] and self.top_non_climax == 0 and self.clock[0] < 7:
+            put_to_clock_helper_fast(self.key(), damage, terminal_states)
+        else:
+            put_to_clock_helper(self.key(), damage, terminal_states)
+        return refresh_outcomes(terminal_states)
+    
+    @lru_cache(maxsize=None)
+    def run_effect(self, steps):
+        '''
+        Run the steps of a declared effect, see utils.define_effect
+        Every step goes through the cached kernels above, so the merging and the
+        refresh are the same as the built-in operators
+        steps: tuple of (primitive, amount), from utils.compile_effect
+        Return: tuple of (state key, probability)
+        '''
+        # The climax count of the last look/mill is part of the frontier key
+        frontier = {(self.key(), 0): Fraction(1)}
+        for step in steps:
+            primitive = step[0]
+            next_frontier = {}
+            for (key, num_climax), weight in frontier.items():
+                if key[2][0] >= 4:
+                    add_outcome(next_frontier, (key, num_climax), weight)
+                    continue
+                if primitive == 'shuffle':
+                    add_outcome(next_frontier, ((*key[:4], 0), num_climax), weight)
+                    continue
+                
+                amount = num_climax if step[1] == 'climax' else step[1]
+                if amount == 0:
+                    add_outcome(next_frontier, (key, 0 if primitive in ('look', 'mill', 'mill_bottom') else num_climax), weight)
+                    continue
+                
+                player = Player.from_key(key)
+                if primitive == 'look':
+                    # define_effect makes a shuffle follow, the looked cards are never used on top
+                    for counted, prob in player.woody(amount):
+                        add_outcome(next_frontier, (key, counted), weight * prob)
+                elif primitive in ('mill', 'mill_bottom'):
+                    milled = player.michiru(amount) if primitive == 'mill' else player.mill_bottom(amount)
+                    for counted, outcomes in milled:
+                        for new_key, prob in outcomes:
+                            add_outcome(next_frontier, (new_key, counted), weight * prob)
+                else:
+                    outcomes = player.put_to_clock(amount) if primitive == 'clock' else player.take_damage(amount)
+                    for new_key, prob in outcomes:
+                        add_outcome(next_frontier, (new_key, num_climax), weight * prob)
+            frontier = next_frontier
+        
+        terminal_states = {}
+        for (key, _), weight in frontier.items():
+            add_outcome(terminal_states, key, weight)
+        return tuple(terminal_states.items())
         
     
 class atkPlayer:
@@ -473,13 +664,13 @@ class GameState:
         self.probability += probability
         
     def __str__(self) -> str:
-        return f"{self.player.deck[1]}/{self.player.deck[0]} {self.player.waiting_room[1]}/{self.player.waiting_room[0]}\n {self.player.level[1]}/{self.player.level[0]} {self.player.clock[1]}/{self.player.clock[0]}\n{len(self.player.top_climax_prob)}\n{self.atk_player.deck[1]}/{self.atk_player.deck[0]} "
+        return f"{self.player.deck[1]}/{self.player.deck[0]} {self.player.waiting_room[1]}/{self.player.waiting_room[0]}\n {self.player.level[1]}/{self.player.level[0]} {self.player.clock[1]}/{self.player.clock[0]}\n{self.player.top_non_climax}\n{self.atk_player.deck[1]}/{self.atk_player.deck[0]} "
     
     def __eq__(self, value: object) -> bool:
         return self.player.same_state(value.player) and self.atk_player == value.atk_player
     
     def __hash__(self) -> int:
-        return hash((self.player.deck, self.player.waiting_room, self.player.level, self.player.clock, self.player.top_climax_prob, self.atk_player.deck))
+        return hash((self.player.deck, self.player.waiting_room, self.player.level, self.player.clock, self.player.top_non_climax, self.atk_player.deck))
         
     def is_terminal(self):
         return self.player.is_terminal()
@@ -490,44 +681,44 @@ class GameState:
     def execute(self, operator):
         """
         operator: (Operator, int)
+        The state is not modified, the returned states are new objects
         """
         if self.is_terminal():
-            return [self]
+            return [GameState(self.player, self.atk_player, self.probability)]
         
         operator_type, num = operator
         base_prob = self.probability
-        self.player.probability = 1
         
         if operator_type == Operator.MOKA:
             player_states = self.player.take_moka(num)
-            return [GameState(player_state.copy(), self.atk_player.copy(), base_prob * player_state.probability) for player_state in player_states]
+            return [GameState(Player.from_key(key), self.atk_player.copy(), base_prob * prob) for key, prob in player_states]
         
         elif operator_type == Operator.MICHIRU:
-            player_states_dict = self.player.michiru(num)
+            player_states_by_climax = self.player.michiru(num)
             final_states = []
-            for damage, state_list in player_states_dict.items():
+            for damage, state_list in player_states_by_climax:
                 if damage == 0:
-                    final_states.extend([GameState(player_state.copy(), self.atk_player.copy(), base_prob * player_state.probability) for player_state in state_list])
+                    final_states.extend([GameState(Player.from_key(key), self.atk_player.copy(), base_prob * prob) for key, prob in state_list])
                 else:
-                    for player_state in state_list:
-                        tmp_player = player_state.copy()
-                        new_base_prob = base_prob * tmp_player.probability
-                        tmp_player.probability = 1
-                        new_player_states = tmp_player.take_damage(damage)
-                        final_states.extend([GameState(new_player_state.copy(), self.atk_player.copy(), new_base_prob * new_player_state.probability) for new_player_state in new_player_states])
+                    for key, prob in state_list:
+                        new_base_prob = base_prob * prob
+                        new_player_states = Player.from_key(key).take_damage(damage)
+                        final_states.extend([GameState(Player.from_key(new_key), self.atk_player.copy(), new_base_prob * new_prob) for new_key, new_prob in new_player_states])
             return final_states
         
         elif operator_type == Operator.WOODY:
-            damage_probs_dict = self.player.woody(num)
+            damage_probs = self.player.woody(num)
+            # The revealed cards are shuffled back, the known top cards are not known anymore
+            shuffled_player = self.player.shuffle_deck()
             final_states = []
-            for damage, prob in damage_probs_dict.items():
+            for damage, prob in damage_probs:
                 if damage == 0:
-                    final_states.append(GameState(self.player.copy(), self.atk_player.copy(), base_prob * prob))
+                    final_states.append(GameState(shuffled_player.copy(), self.atk_player.copy(), base_prob * prob))
                 else:
-                    tmp_player = self.player.copy()
+                    tmp_player = shuffled_player.copy()
                     new_base_prob = base_prob * prob
                     new_player_states = tmp_player.put_to_clock(damage)
-                    final_states.extend([GameState(new_player_state.copy(), self.atk_player.copy(), new_base_prob * new_player_state.probability) for new_player_state in new_player_states])
+                    final_states.extend([GameState(Player.from_key(key), self.atk_player.copy(), new_base_prob * new_prob) for key, new_prob in new_player_states])
             return final_states
         
         elif operator_type == Operator.TRIGGER:
@@ -539,21 +730,23 @@ class GameState:
             
             if atk_player_soul_state is not None:
                 # Trigger the soul trigger
-                tmp_player = self.player.copy()
-                player_states = tmp_player.take_damage(damage + 1)
-                game_states.extend([GameState(player_state.copy(), atk_player_soul_state.copy(), base_prob * soul_prob * player_state.probability) for player_state in player_states])
+                player_states = self.player.take_damage(damage + 1)
+                game_states.extend([GameState(Player.from_key(key), atk_player_soul_state.copy(), base_prob * soul_prob * prob) for key, prob in player_states])
             
             if atk_player_non_soul_state is not None:
                 # Trigger the non-soul trigger
-                tmp_player = self.player.copy()
-                player_states = tmp_player.take_damage(damage)
-                game_states.extend([GameState(player_state.copy(), atk_player_non_soul_state.copy(), base_prob * non_soul_prob * player_state.probability) for player_state in player_states])
+                player_states = self.player.take_damage(damage)
+                game_states.extend([GameState(Player.from_key(key), atk_player_non_soul_state.copy(), base_prob * non_soul_prob * prob) for key, prob in player_states])
                     
             return game_states
         
         elif operator_type == Operator.DAMAGE:
             damage = num
             player_states = self.player.take_damage(damage)
-            return [GameState(player_state.copy(), self.atk_player.copy(), base_prob * player_state.probability) for player_state in player_states]
+            return [GameState(Player.from_key(key), self.atk_player.copy(), base_prob * prob) for key, prob in player_states]
+        
+        elif operator_type == Operator.EFFECT:
+            player_states = self.player.run_effect(compile_effect(operator))
+            return [GameState(Player.from_key(key), self.atk_player.copy(), base_prob * prob) for key, prob in player_states]
         else:
-            raise ValueError(f"Invalid operator: {operator}")
\ No newline at end of file
+            raise ValueError(f"Invalid operator: {operator}")
@@ -0,0 +1,135 @@
+import heapq
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+from fractions import Fraction
+from GameState import Player, atkPlayer, GameState
+
+# deck, waiting room, level, clock, number of known top cards, atk deck
+KEY_FORMAT = struct.Struct('<11H')
+LENGTH_FORMAT = struct.Struct('<II')
+
+def state_key(state):
+    '''
+    Flat tuple of small integers describing a GameState, used as the sort key of the records
+    '''
+    player = state.player
+    return (*player.deck, *player.waiting_room, *player.level, *player.clock,
+            player.top_non_climax, *state.atk_player.deck)
+
+def state_from_key(key, probability):
+    player = Player(key[0:2], key[2:4], key[4:6], key[6:8], Fraction(1), key[8])
+    return GameState(player, atkPlayer(key[9:11]), probability)
+
+def encode_record(key, probability):
+    numerator = probability.numerator.to_bytes((probability.numerator.bit_length() + 7) // 8, 'big')
+    denominator = probability.denominator.to_bytes((probability.denominator.bit_length() + 7) // 8, 'big')
+    return KEY_FORMAT.pack(*key) + LENGTH_FORMAT.pack(len(numerator), len(denominator)) + numerator + denominator
+
+def read_records(path):
+    '''
+    Iterate over the (key, probability) records of a sorted run file
+    '''
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            offset = 0
+            size = len(buffer)
+            while offset < size:
+                key = KEY_FORMAT.unpack_from(buffer, offset)
+                offset += KEY_FORMAT.size
+                num_len, den_len = LENGTH_FORMAT.unpack_from(buffer, offset)
+                offset += LENGTH_FORMAT.size
+                numerator = int.from_bytes(buffer[offset:offset + num_len], 'big')
+                offset += num_len
+                denominator = int.from_bytes(buffer[offset:offset + den_len], 'big')
+                offset += den_len
+                yield key, Fraction(numerator, denominator)
+
+class LayerStore:
+    def __init__(self, max_states, directory=None):
+        '''
+        A layer of states that spills to disk when it grows over max_states.
+        The states are kept in a dict until the budget is reached, then written
+        to a sorted run file. Reading merges the runs in key order and sums the
+        probabilities of equal states, so the result matches an in-memory layer.
+        max_states: number of states kept in memory
+        directory: where the run files are written, a temporary directory by default
+        '''
+        if max_states <= 0:
+            raise ValueError("Memory budget must be positive")
+        self.max_states = max_states
+        self.directory = directory
+        self.own_directory = False
+        self.buffer = {}
+        self.runs = []
+
+    def __len__(self):
+        '''
+        Upper bound of the number of distinct states, exact if nothing was spilled
+        '''
+        return len(self.buffer) + sum(size for _, size in self.runs)
+
+    def is_spilled(self):
+        return self.runs != []
+
+    def add(self, state):
+        key = state_key(state)
+        if key in self.buffer:
+            self.buffer[key] += state.probability
+        else:
+            self.buffer[key] = state.probability
+            if len(self.buffer) > self.max_states:
+                self.spill()
+
+    def spill(self):
+        if not self.buffer:
+            return
+        if self.directory is None:
+            self.directory = tempfile.mkdtemp(prefix='ws_layer_')
+            self.own_directory = True
+
+        path = os.path.join(self.directory, f'run_{id(self)}_{len(self.runs)}.bin')
+        with open(path, 'wb') as f:
+            for key in sorted(self.buffer):
+                f.write(encode_record(key, self.buffer[key]))
+        self.runs.append((path, len(self.buffer)))
+        self.buffer = {}
+
+    def items(self):
+        '''
+        Iterate over (key, probability) in key order, equal states are merged
+        '''
+        sources = [read_records(path) for path, _ in self.runs]
+        sources.append(iter(sorted(self.buffer.items())))
+        last_key, last_prob = None, None
+        for key, probability in heapq.merge(*sources, key=lambda record: record[0]):
+            if key == last_key:
+                last_prob += probability
+                continue
+            if last_key is not None:
+                yield last_key, last_prob
+            last_key, last_prob = key, probability
+        if last_key is not None:
+            yield last_key, last_prob
+
+    def states(self):
+        for key, probability in self.items():
+            yield state_from_key(key, probability)
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        for path, _ in self.runs:
+            if os.path.exists(path):
+                os.remove(path)
+        self.runs = []
+        self.buffer = {}
+        if self.own_directory and self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.directory = None
+            self.own_directory = False
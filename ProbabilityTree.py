@@ -1,24 +1,655 @@
 import time
-from functools import lru_cache
+import bisect
+import heapq
+import json
+import random
+from collections import OrderedDict
+from fractions import Fraction
+from concurrent.futures import ThreadPoolExecutor
+from GameState import Player, atkPlayer, GameState
+from utils import Operator, max_cards, max_damage
+from LayerStore import LayerStore
+
+class LayerCache:
+    def __init__(self, max_states=2000000):
+        '''
+        Keep the intermediate layers of recent runs, keyed on (initial state, operator prefix)
+        A lumped layer is reused by any run whose remaining operators take at most as many
+        cards and only have a trigger if the cached run had one: editing the last group to
+        a weaker one reuses the prefix, appending operators only reuses unlumped layers
+        max_states: memory budget, total number of states kept over all cached layers
+        '''
+        self.max_states = max_states
+        self.num_states = 0
+        self.entries = OrderedDict()
+    
+    def __len__(self):
+        return len(self.entries)
+    
+    def clear(self):
+        self.entries.clear()
+        self.num_states = 0
+    
+    def store(self, root, operator_prefix, layer, leaves, signature=None):
+        '''
+        Save the layer and the leaves after applying operator_prefix to root
+        signature: lumping signature of the layer, see ProbabilityTree.get_lump_signatures,
+        None if the layers of the prefix were not lumped
+        '''
+        key = (root, tuple(operator_prefix))
+        size = len(layer) + len(leaves)
+        if size > self.max_states:
+            return
+        
+        if key in self.entries:
+            old_signature = self.entries[key][3]
+            if self.covers(old_signature, signature) and not self.covers(signature, old_signature):
+                # The cached layer also serves this run and more, keep it
+                self.entries.move_to_end(key)
+                return
+            self.num_states -= self.entries.pop(key)[2]
+        while self.entries and self.num_states + size > self.max_states:
+            _, (_, _, evicted_size, _) = self.entries.popitem(last=False)
+            self.num_states -= evicted_size
+        
+        # Only keep (state, probability) pairs, the states of a tree are updated in place
+        self.entries[key] = (
+            [(state, state.probability) for state in layer.values()],
+            [(state, state.probability) for state in leaves.values()],
+            size,
+            signature,
+        )
+        self.num_states += size
+    
+    def lookup(self, root, operator_list, signatures=None):
+        '''
+        Find the longest cached prefix of operator_list starting from root
+        signatures: lumping signature of every layer, None if the layers are not lumped
+        Return: (prefix length, layer, leaves), layer and leaves are None if nothing is cached
+        '''
+        for prefix_len in range(len(operator_list), 0, -1):
+            key = (root, tuple(operator_list[:prefix_len]))
+            if key not in self.entries:
+                continue
+            layer, leaves, _, signature = self.entries[key]
+            if self.covers(signature, None if signatures is None else signatures[prefix_len - 1]):
+                self.entries.move_to_end(key)
+                return prefix_len, self.restore(layer), self.restore(leaves)
+        return 0, None, None
+    
+    @staticmethod
+    def covers(signature, needed):
+        '''
+        Whether layers lumped with signature are exact for a run that needs the signature needed.
+        A layer lumped for more remaining cards, or with the trigger kept, keeps more fields.
+        The layers before it were lumped for the same operators up to the prefix and the
+        same suffix, so the signature of the last layer decides for the whole prefix
+        '''
+        if signature is None:
+            return True
+        if needed is None:
+            return False
+        return signature[0] >= needed[0] and (signature[1] or not needed[1])
+    
+    @staticmethod
+    def restore(pairs):
+        states = {}
+        for state, probability in pairs:
+            new_state = GameState(state.player.copy(), state.atk_player.copy(), probability)
+            states[new_state] = new_state
+        return states
+
+class SuffixTable:
+    def __init__(self, max_entries=500000):
+        '''
+        Damage distributions of (canonical state, remaining operators), see ProbabilityTree.calculate_backward.
+        The entries don't depend on the initial state or on the operators already applied,
+        so one table can be shared by every tree
+        max_entries: memory budget, the least recently used entries are dropped first
+        '''
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+    
+    def __len__(self):
+        return len(self.entries)
+    
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, key):
+        distribution = self.entries.get(key)
+        if distribution is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return distribution
+    
+    def put(self, key, distribution):
+        self.entries[key] = distribution
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+class DamageDistribution:
+    def __init__(self, probabilities):
+        '''
+        Immutable damage distribution, built once by ProbabilityTree.get_distribution and
+        queried at any threshold without rebuilding the tree
+        probabilities: dict(damage: probability), Fractions or floats
+        '''
+        items = sorted((damage, prob) for damage, prob in probabilities.items() if prob != 0)
+        self.damages = tuple(damage for damage, _ in items)
+        self.probabilities = tuple(prob for _, prob in items)
+        # tails[i]: probability of dealing at least damages[i]
+        tails = []
+        tail = 0
+        for prob in reversed(self.probabilities):
+            tail += prob
+            tails.append(tail)
+        self.tails = tuple(reversed(tails))
+        self.total = tail
+        self.expectation = sum(damage * prob for damage, prob in items)
+        self.variance = sum((damage - self.expectation) ** 2 * prob for damage, prob in items)
+    
+    def __eq__(self, value: object) -> bool:
+        return isinstance(value, DamageDistribution) and self.damages == value.damages and \
+               self.probabilities == value.probabilities
+    
+    def __hash__(self) -> int:
+        return hash((self.damages, self.probabilities))
+    
+    def __len__(self):
+        return len(self.damages)
+    
+    def as_dict(self):
+        return dict(zip(self.damages, self.probabilities))
+    
+    def kill_probability(self, threshold):
+        '''
+        Probability of dealing at least threshold damage
+        '''
+        i = bisect.bisect_left(self.damages, threshold)
+        return self.tails[i] if i < len(self.tails) else 0
+    
+    def cdf(self, damage):
+        '''
+        Probability of dealing at most damage
+        '''
+        return self.total - self.kill_probability(damage + 1)
+    
+    def quantile(self, q):
+        '''
+        Smallest damage whose cdf reaches q
+        '''
+        if not 0 <= q <= 1:
+            raise ValueError(f"Invalid quantile: {q}")
+        cumulative = 0
+        for damage, prob in zip(self.damages, self.probabilities):
+            cumulative += prob
+            if cumulative >= q * self.total:
+                return damage
+        return self.damages[-1]
+    
+    def summary(self, threshold):
+        '''
+        Return: (dict(damage: probability), kill probability, expectation, variance), like calculate_probabilities
+        '''
+        return self.as_dict(), self.kill_probability(threshold), self.expectation, self.variance
+    
+    def to_json(self):
+        # Fractions are written as 'a/b' strings so that they come back exact
+        return json.dumps([[damage, str(prob) if isinstance(prob, Fraction) else prob]
+                           for damage, prob in zip(self.damages, self.probabilities)])
+    
+    @staticmethod
+    def from_json(text):
+        return DamageDistribution({damage: Fraction(prob) if isinstance(prob, str) else prob
+                                   for damage, prob in json.loads(text)})
+
+def mixture_roots(initial_state):
+    '''
+    initial_state: a GameState, or a list of (GameState, weight) when the scene is not known
+    exactly, for example the climax split of the waiting room after a refresh
+    Return: list of distinct GameStates whose probabilities are the normalized weights
+    '''
+    if isinstance(initial_state, GameState):
+        return [initial_state]
+    if not initial_state:
+        raise ValueError("Empty mixture of initial states")
+    if len(set(state.hp() for state, _ in initial_state)) != 1:
+        raise ValueError("The initial states of a mixture must have the same hp, the damage is counted from it")
+    weights = [weight if isinstance(weight, float) else Fraction(weight) for _, weight in initial_state]
+    if any(weight < 0 for weight in weights) or sum(weights) <= 0:
+        raise ValueError("The weights of a mixture must be positive")
+    total = sum(weights)
+    roots = {}
+    for (state, _), weight in zip(initial_state, weights):
+        root = GameState(state.player.copy(), state.atk_player.copy(), state.probability * weight / total)
+        if root in roots:
+            roots[root].add_probability(root.probability)
+        else:
+            roots[root] = root
+    return list(roots.values())
 
 class ProbabilityTree:
-    def __init__(self, initial_state, operator_list):
-        self.root = initial_state
+    def __init__(self, initial_state, operator_list, layer_cache=None, max_layer_states=None, spill_directory=None,
+                 prune_mass=0, prune_max_states=None, lump=True, suffix_table=None, threads=None):
+        '''
+        layer_cache: optional LayerCache shared between trees, an edited operator list
+        only recomputes the layers after the first changed operator
+        max_layer_states: optional memory budget, number of states of a layer kept in memory,
+        larger layers and leaves are spilled to disk under spill_directory
+        prune_mass, prune_max_states: pruned evaluation, see kill_states. Not exact, the
+        dropped probability is reported in pruned_probability
+        lump: merge states that only differ in fields the remaining operators can't observe
+        suffix_table: optional SuffixTable shared between trees, used by calculate_backward
+        threads: expand every layer with a thread pool, the threads share the cached
+        transitions without copying them. Only faster on free-threaded Python builds
+        initial_state: a GameState, or a weighted list of GameStates with the same hp, see
+        mixture_roots. The roots form the first layer, their common descendants are merged
+        and the results are the mixed distribution
+        '''
+        self.initial_state = initial_state
+        self.roots = mixture_roots(initial_state)
+        self.root = self.roots[0]
         self.operator_list = operator_list # List of (Operator, parameter) tuples
         self.op_num = len(operator_list)
         self.leaves = {}
+        self.layer_cache = layer_cache
+        self.max_layer_states = max_layer_states
+        self.spill_directory = spill_directory
+        self.leaf_store = None
+        self.prune_mass = prune_mass
+        self.prune_max_states = prune_max_states
+        self.pruned_probability = 0
+        self.engine = None
+        self.lump = lump
+        self.lump_signatures = None
+        self.suffix_bounds = None
+        self.dead_probability = 0
+        self.survive_probability = 0
+        self.suffix_table = suffix_table
+        self.backward_table = None
+        self.suffixes = None
+        self.threads = threads
+        self.sampled_probability = 0
+        self.kill_error = 0
+        self.expectation_error = 0
+        # Results kept on the tree, a cache keyed on the tree would keep every tree and its leaves alive
+        self.distribution = None
+        # threshold: (kill probability, survive probability)
+        self.kill_probabilities = {}
     
     def __eq__(self, value: object) -> bool:
-        return self.root == value.root and self.operator_list == value.operator_list
+        return self.root_key() == value.root_key() and self.operator_list == value.operator_list and \
+               self.prune_mass == value.prune_mass and self.prune_max_states == value.prune_max_states
 
     def __hash__(self) -> int:
-        return hash((self.root, tuple(self.operator_list)))
+        return hash((self.root_key(), tuple(self.operator_list), self.prune_mass, self.prune_max_states))
+    
+    def root_key(self):
+        # The states compare without their probability, the weights of a mixture are part of the key
+        if len(self.roots) == 1:
+            return self.root
+        return tuple((root, root.probability) for root in self.roots)
+    
+    def root_layer(self):
+        return {root: GameState(root.player.copy(), root.atk_player.copy(), root.probability) for root in self.roots}
+    
+    def pick_root(self, rng):
+        if len(self.roots) == 1:
+            return self.root
+        return rng.choices(self.roots, weights=[float(root.probability) for root in self.roots])[0]
+    
+    def is_pruned(self):
+        return self.prune_mass > 0 or self.prune_max_states is not None
+    
+    def get_lump_signatures(self):
+        '''
+        For the layer after every operator: (the most cards the remaining operators can
+        take from the deck, whether a trigger remains)
+        '''
+        if self.lump_signatures is None or len(self.lump_signatures) != self.op_num:
+            signatures = []
+            remaining_cards = 0
+            remaining_trigger = False
+            for operator in reversed(self.operator_list):
+                signatures.append((remaining_cards, remaining_trigger))
+                remaining_cards += max_cards(operator)
+                remaining_trigger = remaining_trigger or operator[0] == Operator.TRIGGER
+            self.lump_signatures = signatures[::-1]
+        return self.lump_signatures
+    
+    def max_remaining_damage(self, state, op_index):
+        '''
+        Upper bound of the damage the state can still take from operator op_index on.
+        Refresh penalties are counted with the cards the operators can take from the deck:
+        no refresh if they can't empty the deck, at most one if they can't empty the
+        refreshed deck again, and at most one per card otherwise.
+        '''
+        if self.suffix_bounds is None or len(self.suffix_bounds) != self.op_num + 1:
+            bounds = [(0, 0)]
+            for operator in reversed(self.operator_list):
+                damage, cards = bounds[-1]
+                bounds.append((damage + max_damage(operator), cards + max_cards(operator)))
+            self.suffix_bounds = bounds[::-1]
+        
+        return self.damage_bound(state, *self.suffix_bounds[op_index])
+    
+    @staticmethod
+    def damage_bound(state, damage, cards):
+        '''
+        max_remaining_damage for operators dealing at most damage and taking at most cards from the deck
+        '''
+        deck, waiting_room = state.player.deck, state.player.waiting_room
+        if cards < deck[0]:
+            refresh_num = 0
+        elif cards < deck[0] + waiting_room[0] - 1:
+            refresh_num = 1
+        else:
+            refresh_num = cards + 1
+        return damage + refresh_num
+    
+    def calculate_kill_probability(self, threshold):
+        '''
+        Kill probability only, without the damage distribution.
+        States that reached threshold are absorbed at once into a dead bucket, states that
+        can't reach it even if every remaining operator deals its maximum damage are absorbed
+        into a survives bucket, only the others keep expanding.
+        Return: kill probability, the two buckets are kept in dead_probability and survive_probability
+        '''
+        if threshold in self.kill_probabilities:
+            self.dead_probability, self.survive_probability = self.kill_probabilities[threshold]
+            return self.dead_probability
+        init_hp = self.root.hp()
+        dead = 0
+        survive = 0
+        
+        layer = {}
+        for root in self.roots:
+            if threshold <= 0:
+                dead += root.probability
+            elif root.is_terminal() or self.max_remaining_damage(root, 0) < threshold:
+                survive += root.probability
+            else:
+                layer[root] = root
+        
+        for i in range(self.op_num):
+            if not layer:
+                break
+            next_layer = {}
+            for node in layer.values():
+                for state in node.execute(self.operator_list[i]):
+                    damage = state.hp() - init_hp
+                    if damage >= threshold:
+                        dead += state.probability
+                    elif state.is_terminal() or i == self.op_num - 1 or \
+                         damage + self.max_remaining_damage(state, i + 1) < threshold:
+                        survive += state.probability
+                    else:
+                        if self.lump:
+                            state = self.lump_state(state, i)
+                        if state in next_layer:
+                            next_layer[state].add_probability(state.probability)
+                        else:
+                            next_layer[state] = state
+            layer = next_layer
+        
+        self.dead_probability = dead
+        self.survive_probability = survive
+        self.kill_probabilities[threshold] = (dead, survive)
+        return dead
+    
+    def iter_bounds(self, threshold, width=0.01, expectation_width=None, time_limit=None, batch=100):
+        '''
+        Anytime evaluation, expand the most likely unresolved states first and keep
+        rigorous bounds on the kill probability and the expected damage.
+        A state is resolved for the kill once it reached threshold or can't reach it
+        even with the maximum damage of the remaining operators, such states are only
+        expanded to tighten the expectation. An unexpanded state counts its current
+        damage in the lower bound and adds max_remaining_damage in the upper bound.
+        width: stop once the kill probability bounds are this close
+        expectation_width: also wait for the expectation bounds, None to ignore them
+        time_limit: stop after this many seconds
+        batch: number of expansions between two yields
+        Yield: dict(kill_low, kill_high, expectation_low, expectation_high, expanded, pending, time),
+        the bounds are exact Fractions, the last one is yielded when the evaluation stops
+        '''
+        start_time = time.time()
+        init_hp = self.root.hp()
+        total = sum(root.probability for root in self.roots)
+        dead = 0
+        survive = 0
+        leaf_expectation = 0
+        pending_low = 0
+        pending_high = 0
+        # (state, op index): state, the heap holds (kill resolved, -probability, order, key)
+        pending = {}
+        heap = []
+        order = 0
+        
+        def add(state, op_index):
+            nonlocal dead, survive, leaf_expectation, pending_low, pending_high, order
+            damage = state.hp() - init_hp
+            p = state.probability
+            if state.is_terminal() or op_index == self.op_num:
+                leaf_expectation += damage * p
+                if damage >= threshold:
+                    dead += p
+                else:
+                    survive += p
+                return
+            
+            max_left = self.max_remaining_damage(state, op_index)
+            if damage >= threshold:
+                dead += p
+                resolved = True
+            elif damage + max_left < threshold:
+                survive += p
+                resolved = True
+            else:
+                resolved = False
+            pending_low += damage * p
+            pending_high += (damage + max_left) * p
+            
+            key = (state, op_index)
+            if key in pending:
+                pending[key].add_probability(p)
+                p = pending[key].probability
+            else:
+                pending[key] = state
+            heapq.heappush(heap, (resolved, -float(p), order, key))
+            order += 1
+        
+        def bounds():
+            return {
+                'kill_low': dead,
+                'kill_high': total - survive,
+                'expectation_low': leaf_expectation + pending_low,
+                'expectation_high': leaf_expectation + pending_high,
+                'expanded': expanded,
+                'pending': len(pending),
+                'time': time.time() - start_time,
+            }
+        
+        def is_done():
+            if total - survive - dead > width:
+                return False
+            return expectation_width is None or pending_high - pending_low <= expectation_width
+        
+        expanded = 0
+        for root in self.root_layer().values():
+            add(root, 0)
+        while heap and not is_done():
+            for _ in range(batch):
+                if not heap or is_done():
+                    break
+                _, _, _, key = heapq.heappop(heap)
+                if key not in pending:
+                    continue
+                state = pending.pop(key)
+                op_index = key[1]
+                
+                # Take the state out of the bounds, its children replace it
+                damage = state.hp() - init_hp
+                p = state.probability
+                max_left = self.max_remaining_damage(state, op_index)
+                pending_low -= damage * p
+                pending_high -= (damage + max_left) * p
+                if damage >= threshold:
+                    dead -= p
+                elif damage + max_left < threshold:
+                    survive -= p
+                
+                for child in state.execute(self.operator_list[op_index]):
+                    if self.lump and not child.is_terminal() and op_index + 1 < self.op_num:
+                        child = self.lump_state(child, op_index)
+                    add(child, op_index + 1)
+                expanded += 1
+            if time_limit is not None and time.time() - start_time > time_limit:
+                break
+            if heap and not is_done():
+                yield bounds()
+        yield bounds()
+    
+    def calculate_bounds(self, threshold, width=0.01, expectation_width=None, time_limit=None, callback=None):
+        '''
+        Run iter_bounds until it stops
+        callback: optional function called with every bound update
+        Return: the final bounds
+        '''
+        result = None
+        for result in self.iter_bounds(threshold, width, expectation_width, time_limit):
+            if callback is not None:
+                callback(result)
+        return result
+    
+    def lump_state(self, state, op_index):
+        '''
+        Project a state of the layer after operator op_index onto the fields the remaining
+        operators can still observe, so that equivalent states merge:
+        the waiting room and the climaxes in level and clock only matter if the deck can
+        be refreshed, the attacker deck only matters if a trigger remains.
+        The result stays exact.
+        '''
+        return self.lump_to(state, *self.get_lump_signatures()[op_index])
+    
+    @staticmethod
+    def lump_to(state, remaining_cards, remaining_trigger):
+        '''
+        lump_state with the signature of the remaining operators given directly
+        '''
+        player = state.player
+        deck, waiting_room, level, clock, top_non_climax = player.deck, player.waiting_room, player.level, player.clock, player.top_non_climax
+        atk_deck = state.atk_player.deck
+        
+        changed = False
+        if level[1] != 0:
+            level = (level[0], 0)
+            changed = True
+        # The deck can't run out, the refresh never happens
+        if deck[0] > remaining_cards and (waiting_room != (0, 0) or clock[1] != 0):
+            waiting_room = (0, 0)
+            clock = (clock[0], 0)
+            changed = True
+        if not remaining_trigger and atk_deck != (0, 0):
+            atk_deck = (0, 0)
+            changed = True
+        
+        if not changed:
+            return state
+        return GameState(Player(deck, waiting_room, level, clock, player.probability, top_non_climax), atkPlayer(atk_deck), state.probability)
+    
+    def get_suffix_signatures(self):
+        '''
+        Lumping signature of the states before every operator, and of the leaves
+        '''
+        signatures = [(0, False)] * (self.op_num + 1)
+        for i in range(self.op_num - 1, -1, -1):
+            cards, trigger = signatures[i + 1]
+            signatures[i] = (cards + max_cards(self.operator_list[i]), trigger or self.operator_list[i][0] == Operator.TRIGGER)
+        return signatures
+    
+    def has_backward(self):
+        '''
+        Whether suffix_table already holds the distribution of the root, calculate_backward is then a lookup
+        '''
+        if self.suffix_table is None or self.op_num == 0:
+            return False
+        for root in self.roots:
+            if self.lump:
+                root = self.lump_to(root, *self.get_suffix_signatures()[0])
+            if (root, tuple(self.operator_list)) not in self.suffix_table.entries:
+                return False
+        return True
+    
+    def calculate_backward(self, threshold):
+        '''
+        Backward evaluation, the damage distribution of a state under the remaining operators
+        is the mix of the distributions of its children. The distributions are memoized on
+        (lumped state, remaining operators) in suffix_table, so runs from other initial states
+        or with other operator lists reuse every state they share with earlier runs
+        Return: same as calculate_probabilities
+        '''
+        result = {}
+        for root in self.roots:
+            for damage, prob in self.suffix_distribution(root).items():
+                result[damage] = result.get(damage, 0) + root.probability * prob
+        return DamageDistribution(result).summary(threshold)
+    
+    def suffix_distribution(self, state, op_index=0):
+        '''
+        Damage distribution of state under the operators from op_index on, see calculate_backward
+        Return: dict(damage: probability), the probability of state itself is not applied
+        '''
+        if self.backward_table is None:
+            self.backward_table = self.suffix_table if self.suffix_table is not None else SuffixTable(max_entries=float('inf'))
+            self.suffixes = [tuple(self.operator_list[i:]) for i in range(self.op_num + 1)]
+        if state.is_terminal() or op_index == self.op_num:
+            return {0: 1}
+        if self.lump:
+            state = self.lump_to(state, *self.get_suffix_signatures()[op_index])
+        key = (state, self.suffixes[op_index])
+        result = self.backward_table.get(key)
+        if result is not None:
+            return result
+        
+        # Merge equal children before descending
+        children = {}
+        start = GameState(state.player.copy(), state.atk_player.copy(), 1)
+        for child in start.execute(self.operator_list[op_index]):
+            if child in children:
+                children[child].add_probability(child.probability)
+            else:
+                children[child] = child
+        
+        hp = state.hp()
+        result = {}
+        for child in children.values():
+            shift = child.hp() - hp
+            for damage, prob in self.suffix_distribution(child, op_index + 1).items():
+                damage += shift
+                if damage in result:
+                    result[damage] += child.probability * prob
+                else:
+                    result[damage] = child.probability * prob
+        # Key on a copy, the state of the caller may still be updated
+        self.backward_table.put((GameState(state.player.copy(), state.atk_player.copy(), 1), self.suffixes[op_index]), result)
+        return result
     
     def build_tree(self, debug=False, show=False):
-        def build_tree_helper(layer, op_index, debug=False):
+        if self.max_layer_states is not None:
+            return self.build_tree_out_of_core()
+        
+        def build_tree_helper(nodes, op_index, leaves, debug=False):
             next_layer = {}
             
-            for node in layer.values():
+            for node in nodes:
                 next_states = node.execute(self.operator_list[op_index])
                 # if debug:
                 #     # Check if the sum of probabilities remains the same
@@ -28,24 +659,28 @@ class ProbabilityTree:
                 #         print(f"Error: Probability sum is not the same, sum is {tot_prob}, expected {node.probability}, the difference is {tot_prob - node.probability}")
                 #         print(f"Layer {op_index + 1} operator: {self.operator_list[op_index]}")
                 #         player = node.player
-                #         print(f"parent node: {player.deck}, {player.waiting_room}, {player.level}, {player.clock}, {player.probability}, {player.top_climax_prob}")
+                #         print(f"parent node: {player.deck}, {player.waiting_room}, {player.level}, {player.clock}, {player.probability}, {player.top_non_climax}")
                 #         atk_player = node.atk_player
                 #         print(f"atk player: {atk_player.deck}, {atk_player.stock}, {atk_player.probability}")
                         
                 #         print(f"next states:")
                 #         for state in next_states:
                 #             player = state.player
-                #             print(f"player: {player.deck}, {player.waiting_room}, {player.level}, {player.clock}, {player.probability}, {player.top_climax_prob}")
+                #             print(f"player: {player.deck}, {player.waiting_room}, {player.level}, {player.clock}, {player.probability}, {player.top_non_climax}")
                 #             atk_player = state.atk_player
                 #             print(f"atk player: {atk_player.deck}, {atk_player.stock}, {atk_player.probability}")
                 #         print("=====================================")
                 for state in next_states:
-                    if state.is_terminal() or op_index == self.op_num - 1:
-                        if state in self.leaves:
-                            self.leaves[state].add_probability(state.probability)
+                    if state.is_terminal():
+                        if state in leaves:
+                            leaves[state].add_probability(state.probability)
                         else:
-                            self.leaves[state] = state
+                            leaves[state] = state
                     else:
+                        # The states after the last operator stay a layer until the cache has
+                        # stored it, a longer operator list goes on from them
+                        if self.lump and op_index < self.op_num - 1:
+                            state = self.lump_state(state, op_index)
                         if state in next_layer:
                             next_layer[state].add_probability(state.probability)
                         else:
@@ -57,18 +692,73 @@ class ProbabilityTree:
             #     for state in next_layer:
             #         tot_prob += state.probability
             #         player = state.player
-            #         print(f"player: {player.deck}, {player.waiting_room}, {player.level}, {player.clock}, {player.probability}, {player.top_climax_prob}")
+            #         print(f"player: {player.deck}, {player.waiting_room}, {player.level}, {player.clock}, {player.probability}, {player.top_non_climax}")
             #     print(f"Layer {op_index + 1} total probability: {tot_prob}")
         
             return next_layer
+        
+        def build_tree_threaded(layer, op_index, executor):
+            # Every thread expands its own chunk into its own dicts, the chunks are merged here
+            def expand_chunk(chunk):
+                leaves = {}
+                return build_tree_helper(chunk, op_index, leaves), leaves
+            
+            nodes = list(layer.values())
+            chunk_num = min(len(nodes), self.threads * 4)
+            chunks = [nodes[i::chunk_num] for i in range(chunk_num)]
+            next_layer = {}
+            for chunk_layer, chunk_leaves in executor.map(expand_chunk, chunks):
+                for merged, part in ((next_layer, chunk_layer), (self.leaves, chunk_leaves)):
+                    for state in part.values():
+                        if state in merged:
+                            merged[state].add_probability(state.probability)
+                        else:
+                            merged[state] = state
+            return next_layer
 
-        last_layer = {self.root: self.root}
+        # A tree built again starts over, the leaves of the last build would be counted twice
+        self.leaves = {}
+        last_layer = self.root_layer()
         tot_time = 0
         tot_state = 0
+        start = 0
         
-        for i in range(self.op_num):
+        # Pruned layers are not exact, keep them out of the cache, and the cache is keyed on a single root
+        layer_cache = None if self.is_pruned() or len(self.roots) > 1 else self.layer_cache
+        
+        signatures = self.get_lump_signatures() if self.lump else None
+        
+        if layer_cache is not None:
+            prefix_len, layer, leaves = layer_cache.lookup(self.root, self.operator_list, signatures)
+            if prefix_len > 0:
+                start, last_layer, self.leaves = prefix_len, layer, leaves
+                if self.lump and start < self.op_num:
+                    # The cached layer may have been lumped for more remaining operators
+                    last_layer = {}
+                    for state in layer.values():
+                        state = self.lump_state(state, start - 1)
+                        if state in last_layer:
+                            last_layer[state].add_probability(state.probability)
+                        else:
+                            last_layer[state] = state
+        
+        executor = ThreadPoolExecutor(max_workers=self.threads) if self.threads is not None and self.threads > 1 else None
+        for i in range(start, self.op_num):
             # if not show:
-            last_layer = build_tree_helper(last_layer, i, debug=debug)
+            if executor is not None and len(last_layer) > 1:
+                last_layer = build_tree_threaded(last_layer, i, executor)
+            else:
+                last_layer = build_tree_helper(last_layer.values(), i, self.leaves, debug=debug)
+            if self.is_pruned() and i < self.op_num - 1:
+                last_layer = self.kill_states(last_layer, self.prune_mass, self.prune_max_states)
+            if layer_cache is not None:
+                layer_cache.store(self.root, self.operator_list[:i + 1], last_layer, self.leaves, None if signatures is None else signatures[i])
+        # The last layer is final
+        for state in last_layer.values():
+            if state in self.leaves:
+                self.leaves[state].add_probability(state.probability)
+            else:
+                self.leaves[state] = state
             # else:
             #     print(f"Layer {i + 1} / {self.op_num}: {len(last_layer)} states to process", end='')
             #     tot_state += len(last_layer)
@@ -85,44 +775,306 @@ class ProbabilityTree:
             #         #     print(f"Estimated time: {tot_time / tot_state * len(last_layer)} s")
             #     else:
             #         print(f"Leaves: {len(self.leaves)}")
+        if executor is not None:
+            executor.shutdown()
         return 
     
-    def kill_states(self, layer, threshold=0.05):
-        layer.sort(key=lambda x: x.probability, reverse=True)
-        p = 0
-        x = 0
-        while p < threshold:
-            p += layer.pop().probability
-            x += 1
+    def build_tree_out_of_core(self):
+        '''
+        Same as build_tree, but every layer is kept in a LayerStore, layers over the
+        memory budget are spilled to disk and expanded one record at a time
+        '''
+        def new_store():
+            return LayerStore(self.max_layer_states, self.spill_directory)
         
-        for s in layer:
-            s.probability /= (1 - p)
-            s.player.probability = s.probability
-            s.atk_player.probability = s.probability
+        self.leaves = {}
+        if self.leaf_store is not None:
+            self.leaf_store.close()
+            self.leaf_store = None
+        last_layer = new_store()
+        for root in self.root_layer().values():
+            last_layer.add(root)
+        leaves = new_store()
         
-        print(f"Killed {x} states covering {float(p)} probability, remaining {len(layer)} states")
+        for i in range(self.op_num):
+            next_layer = new_store()
+            for node in last_layer.states():
+                for state in node.execute(self.operator_list[i]):
+                    if state.is_terminal() or i == self.op_num - 1:
+                        leaves.add(state)
+                    elif self.lump:
+                        next_layer.add(self.lump_state(state, i))
+                    else:
+                        next_layer.add(state)
+            last_layer.close()
+            last_layer = next_layer
+        last_layer.close()
+        
+        if leaves.is_spilled():
+            self.leaf_store = leaves
+        else:
+            for state in leaves.states():
+                if state in self.leaves:
+                    self.leaves[state].add_probability(state.probability)
+                else:
+                    self.leaves[state] = state
+            leaves.close()
         return
     
-    @lru_cache(maxsize=None)
-    def calculate_probabilities(self, threshold):
+    def iter_leaves(self):
+        yield from self.leaves.values()
+        if self.leaf_store is not None:
+            yield from self.leaf_store.states()
+    
+    def kill_states(self, layer, threshold=0.05, max_states=None):
+        '''
+        Drop the least likely states of a layer, up to threshold of the layer probability,
+        and keep at most max_states states. The remaining states are scaled up so that
+        the layer keeps its total probability.
+        Return: the pruned layer
+        '''
+        states = sorted(layer.values(), key=lambda x: x.probability, reverse=True)
+        tot_prob = sum(s.probability for s in states)
+        p = 0
+        if max_states is not None:
+            while len(states) > max(max_states, 1):
+                p += states.pop().probability
+        while len(states) > 1 and p + states[-1].probability <= threshold * tot_prob:
+            p += states.pop().probability
+        
+        if p == 0:
+            return layer
+        
+        scale = tot_prob / (tot_prob - p)
+        for s in states:
+            s.set_probability(s.probability * scale)
+        self.pruned_probability += p
+        return {s: s for s in states}
+    
+    def sample_leaf(self, rng, start_state=None, start=0):
+        '''
+        Follow one random path from the root, or from start_state before operator start, return the hp of the leaf
+        '''
+        if start_state is None:
+            start_state = self.pick_root(rng)
+        state = GameState(start_state.player.copy(), start_state.atk_player.copy(), 1)
+        for operator in self.operator_list[start:]:
+            if state.is_terminal():
+                break
+            next_states = state.execute(operator)
+            state = rng.choices(next_states, weights=[float(s.probability) for s in next_states])[0]
+            state.set_probability(1)
+        return state.hp()
+    
+    def sample(self, num_samples, threshold, seed=None):
+        '''
+        Monte Carlo evaluation, same outputs as calculate_probabilities but with float probabilities
+        '''
+        rng = random.Random(seed)
+        init_hp = self.root.hp()
+        result = {}
+        for _ in range(num_samples):
+            damage = self.sample_leaf(rng) - init_hp
+            result[damage] = result.get(damage, 0) + 1 / num_samples
+        
+        result = dict(sorted(result.items()))
+        kill_prob = sum(prob for damage, prob in result.items() if damage >= threshold)
+        expecated_damage = sum(damage * prob for damage, prob in result.items())
+        variance = sum((damage - expecated_damage) ** 2 * prob for damage, prob in result.items())
+        return result, kill_prob, expecated_damage, variance
+    
+    def calculate_hybrid(self, threshold, mass_cutoff=1e-4, num_samples=2000, seed=None):
+        '''
+        Exact expansion of the likely states, Monte Carlo continuation of the rare ones.
+        A state whose probability falls under mass_cutoff leaves the exact layers and joins
+        the tail, num_samples random paths continue from tail states drawn by their probability.
+        Return: same as calculate_probabilities with float probabilities. The sampled mass and
+        the standard errors of the kill probability and the expectation, which only come from
+        the sampled mass, are kept in sampled_probability, kill_error and expectation_error
+        '''
+        rng = random.Random(seed)
+        init_hp = self.root.hp()
+        exact = {}
+        tail = []
+        layer = self.root_layer()
+        
+        for i in range(self.op_num):
+            next_layer = {}
+            for node in layer.values():
+                for state in node.execute(self.operator_list[i]):
+                    if state.is_terminal() or i == self.op_num - 1:
+                        damage = state.hp() - init_hp
+                        exact[damage] = exact.get(damage, 0) + state.probability
+                        continue
+                    if self.lump:
+                        state = self.lump_state(state, i)
+                    if state in next_layer:
+                        next_layer[state].add_probability(state.probability)
+                    else:
+                        next_layer[state] = state
+            layer = {}
+            for state in next_layer.values():
+                if state.probability < mass_cutoff:
+                    tail.append((state, i + 1))
+                else:
+                    layer[state] = state
+        
+        result = {damage: float(prob) for damage, prob in exact.items()}
+        tail_mass = float(sum(state.probability for state, _ in tail))
+        kill_error = 0
+        expectation_error = 0
+        if tail:
+            weights = [float(state.probability) for state, _ in tail]
+            damages = []
+            for state, start in rng.choices(tail, weights=weights, k=num_samples):
+                damages.append(self.sample_leaf(rng, state, start) - init_hp)
+            for damage in damages:
+                result[damage] = result.get(damage, 0) + tail_mass / num_samples
+            
+            kill_rate = sum(1 for damage in damages if damage >= threshold) / num_samples
+            mean = sum(damages) / num_samples
+            spread = sum((damage - mean) ** 2 for damage in damages) / max(num_samples - 1, 1)
+            kill_error = tail_mass * (kill_rate * (1 - kill_rate) / num_samples) ** 0.5
+            expectation_error = tail_mass * (spread / num_samples) ** 0.5
+        
+        self.sampled_probability = tail_mass
+        self.kill_error = kill_error
+        self.expectation_error = expectation_error
+        
+        result = dict(sorted(result.items()))
+        kill_prob = sum(prob for damage, prob in result.items() if damage >= threshold)
+        expecated_damage = sum(damage * prob for damage, prob in result.items())
+        variance = sum((damage - expecated_damage) ** 2 * prob for damage, prob in result.items())
+        return result, kill_prob, expecated_damage, variance
+    
+    def estimate(self, probe_states=5000, num_samples=200, seed=0):
+        '''
+        Dry run predicting the layer sizes and the runtime of build_tree.
+        The exact layers are built while they stay under probe_states, which gives the
+        time per state and how much the states merge. The later layers are extrapolated
+        with the branching factor of num_samples random paths.
+        Return: dict(layer_sizes, exact_layers, states, max_layer, state_time, sample_time, time)
+        '''
+        start_time = time.time()
+        layer = self.root_layer()
+        layer_sizes = []
+        expanded = 0
+        merge_ratio = 1
+        
+        while len(layer_sizes) < self.op_num - 1 and len(layer) <= probe_states:
+            operator = self.operator_list[len(layer_sizes)]
+            next_layer = {}
+            raw_num = 0
+            for node in layer.values():
+                for state in node.execute(operator):
+                    if state.is_terminal():
+                        continue
+                    if self.lump:
+                        state = self.lump_state(state, len(layer_sizes))
+                    raw_num += 1
+                    if state in next_layer:
+                        next_layer[state].add_probability(state.probability)
+                    else:
+                        next_layer[state] = state
+            expanded += len(layer)
+            merge_ratio = len(next_layer) / raw_num if raw_num else 1
+            layer_sizes.append(len(next_layer))
+            layer = next_layer
+        state_time = (time.time() - start_time) / max(expanded, 1)
+        exact_layers = len(layer_sizes)
+        
+        # Average number of non-terminal children along random paths
+        # and the values seen in every field of the states, which caps the layer size
+        rng = random.Random(seed)
+        branching = [[0, 0] for _ in range(self.op_num)]
+        fields = [[set() for _ in range(6)] for _ in range(self.op_num)]
+        sample_start = time.time()
+        for _ in range(num_samples):
+            root = self.pick_root(rng)
+            state = GameState(root.player.copy(), root.atk_player.copy(), 1)
+            for i, operator in enumerate(self.operator_list):
+                if state.is_terminal():
+                    break
+                next_states = state.execute(operator)
+                branching[i][0] += sum(1 for s in next_states if not s.is_terminal())
+                branching[i][1] += 1
+                for s in next_states:
+                    for field, value in zip(fields[i], (*s.player.key(), s.atk_player.deck)):
+                        field.add(value)
+                state = rng.choices(next_states, weights=[float(s.probability) for s in next_states])[0]
+                state.set_probability(1)
+        sample_time = (time.time() - sample_start) / max(num_samples, 1)
+        
+        size = layer_sizes[-1] if layer_sizes else 1
+        for i in range(exact_layers, self.op_num - 1):
+            children, visits = branching[i]
+            cap = 1
+            for field in fields[i]:
+                cap *= max(len(field), 1)
+            size = max(1, min(round(size * (children / visits if visits else 0) * merge_ratio), cap))
+            layer_sizes.append(size)
+        
+        # The roots and every layer but the leaves are expanded
+        states = len(self.roots) + sum(layer_sizes)
+        return {
+            'layer_sizes': layer_sizes,
+            'exact_layers': exact_layers,
+            'states': states,
+            'max_layer': max(layer_sizes, default=1),
+            'state_time': state_time,
+            'sample_time': sample_time,
+            'time': state_time * states,
+        }
+    
+    def calculate_auto(self, threshold, time_budget=10, memory_budget=2000000, min_beam=1000):
+        '''
+        Choose the evaluation engine from the estimate:
+        exact if it fits in time_budget seconds and memory_budget states per layer,
+        pruned (keeping the most likely states of each layer) if a wide enough beam fits,
+        sampling otherwise.
+        Return: (result of calculate_probabilities, engine name), the engine is also kept in self.engine
+        '''
+        estimate = self.estimate()
+        if estimate['time'] <= time_budget and estimate['max_layer'] <= memory_budget:
+            self.engine = 'exact'
+            return self.calculate_probabilities(threshold), self.engine
+        
+        beam = min(memory_budget, int(time_budget / max(estimate['state_time'], 1e-9) / max(self.op_num, 1)))
+        if beam >= min_beam:
+            self.engine = 'pruned'
+            tree = ProbabilityTree(self.initial_state, self.operator_list, prune_max_states=beam)
+            result = tree.calculate_probabilities(threshold)
+            self.pruned_probability = tree.pruned_probability
+            return result, self.engine
+        
+        self.engine = 'sampling'
+        num_samples = max(100, int(time_budget / max(estimate['sample_time'], 1e-9)))
+        return self.sample(num_samples, threshold), self.engine
+    
+    def get_distribution(self):
+        '''
+        Build the tree once and keep its damage distribution, every threshold,
+        quantile or statistic is then answered from the distribution
+        Return: DamageDistribution
+        '''
+        if self.distribution is not None:
+            return self.distribution
         self.build_tree()
         result = {}
         init_hp = self.root.hp()
         
-        for leaf in self.leaves.values():
+        for leaf in self.iter_leaves():
             damage = leaf.hp() - init_hp
             if damage in result:
                 result[damage] += leaf.probability
             else:
                 result[damage] = leaf.probability
-                
-        # Sort the result dictionary by damage dealt
-        result = dict(sorted(result.items()))
-        kill_prob = sum(prob for damage, prob in result.items() if damage >= threshold)
-        expecated_damage = sum(damage * prob for damage, prob in result.items())
-        variance = sum((damage - expecated_damage) ** 2 * prob for damage, prob in result.items())
-        check = sum(result.values())
-        if check != 1:
-            print(f"Error: Probability sum is not 1, sum is {check}")
-        return result, kill_prob, expecated_damage, variance
-
+        
+        distribution = DamageDistribution(result)
+        if abs(distribution.total - 1) > 1e-9:
+            print(f"Error: Probability sum is not 1, sum is {distribution.total}")
+        self.distribution = distribution
+        return distribution
+    
+    def calculate_probabilities(self, threshold):
+        return self.get_distribution().summary(threshold)
@@ -0,0 +1,234 @@
+# 预计算图集：常用卡组和操作序列的伤害分布写入带索引的二进制文件，查询时用 mmap 直接读取
+import itertools
+import mmap
+import os
+import struct
+from concurrent.futures import ProcessPoolExecutor
+from GameState import Player, atkPlayer, GameState, KERNEL_VERSION
+from ProbabilityTree import ProbabilityTree
+from utils import parse_operator_list, cache_str, effect_definitions, load_effects
+
+MAGIC = b'WSATLAS2'
+# magic, kernel version, number of entries, number of damage values per entry, number of operator lines
+HEADER_FORMAT = struct.Struct('<8sIIII')
+# deck, deck climax, waiting room, waiting room climax, hp, atk, atk soul, operator line id
+KEY_FORMAT = struct.Struct('<7HI')
+LENGTH_FORMAT = struct.Struct('<I')
+SCENE_AXES = ('deck', 'deck_climax', 'waiting_room', 'waiting_room_climax', 'atk', 'atk_soul')
+
+def canonical_operators(operator_list):
+    '''
+    Same text for every spelling of the same operator list, the groups don't change the distribution.
+    Effects are written with their steps, a redefined effect is not found in the atlas
+    '''
+    return ' '.join(cache_str(operator).lower() for operator in parse_operator_list(operator_list))
+
+def damage_distribution(deck, deck_climax, waiting_room, waiting_room_climax, hp, atk, atk_soul, operator_list):
+    '''
+    Return: dict(damage: Fraction), the live evaluation
+    '''
+    initial_player = Player((deck, deck_climax), (waiting_room, waiting_room_climax), (hp // 7, 0), (hp % 7, 0))
+    initial_state = GameState(initial_player, atkPlayer((atk, atk_soul)), 1)
+    result, _, _, _ = ProbabilityTree(initial_state, parse_operator_list(operator_list)).calculate_probabilities(28 - hp)
+    return result
+
+def evaluate_entries(entries):
+    '''
+    Worker entry of build_atlas
+    '''
+    results = []
+    for key, operator_list in entries:
+        # An operator list that doesn't parse is an error, not an invalid scene
+        parse_operator_list(operator_list)
+        try:
+            results.append((key, damage_distribution(*key[:7], operator_list)))
+        except ValueError:
+            # Not a valid scene, left out of the atlas
+            results.append((key, None))
+    return results
+
+def build_atlas(path, grid, operator_library, hps=range(28), workers=1):
+    '''
+    Precompute the damage distribution of every scene of the grid, at every hp of hps,
+    for every operator line of operator_library, and write them to path
+    grid: dict(axis name: list of values) over SCENE_AXES, the defaults are a 50 card deck
+    with 8 climaxes, an empty waiting room and a 50 card attacker deck with 15 souls
+    operator_library: list of operator list strings, like the GUI input box
+    Return: number of entries written
+    '''
+    defaults = {'deck': [50], 'deck_climax': [8], 'waiting_room': [0], 'waiting_room_climax': [0], 'atk': [50], 'atk_soul': [15]}
+    for name in grid:
+        if name not in SCENE_AXES:
+            raise ValueError(f"Invalid atlas axis: {name}")
+    axes = [list(grid.get(name, defaults[name])) for name in SCENE_AXES]
+    # canonical text: one of its spellings, the canonical text of an effect can't be parsed back
+    spellings = {canonical_operators(operator_list): operator_list for operator_list in operator_library}
+    lines = sorted(spellings)
+
+    entries = []
+    for deck, deck_climax, waiting_room, waiting_room_climax, atk, atk_soul in itertools.product(*axes):
+        if deck_climax > deck or waiting_room_climax > waiting_room or atk_soul > atk:
+            continue
+        for hp in hps:
+            for line_id, operator_list in enumerate(lines):
+                entries.append(((deck, deck_climax, waiting_room, waiting_room_climax, hp, atk, atk_soul, line_id), spellings[operator_list]))
+
+    if workers == 1:
+        results = evaluate_entries(entries)
+    else:
+        chunks = [entries[i::workers * 4] for i in range(workers * 4)]
+        with ProcessPoolExecutor(max_workers=workers, initializer=load_effects, initargs=(effect_definitions(),)) as executor:
+            results = [result for chunk_results in executor.map(evaluate_entries, chunks) for result in chunk_results]
+    results = sorted((key, distribution) for key, distribution in results if distribution is not None)
+    width = max((max(distribution) + 1 for _, distribution in results), default=1)
+
+    # Fixed size rows, the row of an entry is found from its position in the sorted index
+    value_format = struct.Struct(f'<{width}d')
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER_FORMAT.pack(MAGIC, KERNEL_VERSION, len(results), width, len(lines)))
+        for operator_list in lines:
+            text = operator_list.encode('utf-8')
+            f.write(LENGTH_FORMAT.pack(len(text)) + text)
+        for key, _ in results:
+            f.write(KEY_FORMAT.pack(*key))
+        for _, distribution in results:
+            f.write(value_format.pack(*[float(distribution.get(damage, 0)) for damage in range(width)]))
+    os.replace(tmp_path, path)
+    return len(results)
+
+class Atlas:
+    def __init__(self, path):
+        '''
+        Read only view of an atlas file, the file is memory mapped and searched in place
+        An atlas built with other transition kernels is rejected, it has to be built again
+        '''
+        self.file = open(path, 'rb')
+        self.buffer = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.buffer) < HEADER_FORMAT.size or self.buffer[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise ValueError(f"{path} is not an atlas file of this version, build it again")
+        _, version, self.size, self.width, line_num = HEADER_FORMAT.unpack_from(self.buffer, 0)
+        if version != KERNEL_VERSION:
+            self.close()
+            raise ValueError(f"{path} was built with kernel version {version}, the current one is {KERNEL_VERSION}, build it again")
+
+        offset = HEADER_FORMAT.size
+        self.lines = {}
+        for line_id in range(line_num):
+            length, = LENGTH_FORMAT.unpack_from(self.buffer, offset)
+            offset += LENGTH_FORMAT.size
+            self.lines[bytes(self.buffer[offset:offset + length]).decode('utf-8')] = line_id
+            offset += length
+        self.index_offset = offset
+        self.data_offset = offset + self.size * KEY_FORMAT.size
+        self.value_format = struct.Struct(f'<{self.width}d')
+
+    def close(self):
+        if self.buffer is not None:
+            self.buffer.close()
+            self.buffer = None
+        self.file.close()
+
+    def __len__(self):
+        return self.size
+
+    def find(self, key):
+        # Binary search of the sorted index
+        low, high = 0, self.size
+        while low < high:
+            middle = (low + high) // 2
+            if KEY_FORMAT.unpack_from(self.buffer, self.index_offset + middle * KEY_FORMAT.size) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.size and KEY_FORMAT.unpack_from(self.buffer, self.index_offset + low * KEY_FORMAT.size) == key:
+            return low
+        return None
+
+    def lookup(self, deck, deck_climax, waiting_room, waiting_room_climax, hp, atk, atk_soul, operator_list):
+        '''
+        Return: dict(damage: float probability), None if the atlas doesn't cover the scene
+        '''
+        try:
+            line_id = self.lines.get(canonical_operators(operator_list))
+        except ValueError:
+            return None
+        if line_id is None:
+            return None
+        row = self.find((deck, deck_climax, waiting_room, waiting_room_climax, hp, atk, atk_soul, line_id))
+        if row is None:
+            return None
+        values = self.value_format.unpack_from(self.buffer, self.data_offset + row * self.value_format.size)
+        return {damage: prob for damage, prob in enumerate(values) if prob > 0}
+
+    def kill_curve(self, deck, deck_climax, waiting_room, waiting_room_climax, atk, atk_soul, operator_list):
+        '''
+        Kill probability at remaining HP 1 to 28, like the GUI curve, None if a point is not covered
+        '''
+        curve = []
+        for threshold in range(1, 29):
+            distribution = self.lookup(deck, deck_climax, waiting_room, waiting_room_climax, 28 - threshold, atk, atk_soul, operator_list)
+            if distribution is None:
+                return None
+            curve.append(sum(prob for damage, prob in distribution.items() if damage >= threshold))
+        return curve
+
+def distribution_stats(distribution, threshold):
+    '''
+    Return: (kill probability, expectation, variance) of a damage distribution
+    '''
+    kill_prob = sum(prob for damage, prob in distribution.items() if damage >= threshold)
+    expectation = sum(damage * prob for damage, prob in distribution.items())
+    variance = sum((damage - expectation) ** 2 * prob for damage, prob in distribution.items())
+    return kill_prob, expectation, variance
+
+def query(deck, deck_climax, waiting_room, waiting_room_climax, hp, atk, atk_soul, operator_list, atlas=None):
+    '''
+    Answer from the atlas when it covers the scene, evaluate it live otherwise
+    Return: (dict(damage: probability), kill probability, expectation, variance, 'atlas' or 'live'),
+    the atlas gives floats, the live evaluation exact Fractions
+    '''
+    args = (deck, deck_climax, waiting_room, waiting_room_climax, hp, atk, atk_soul, operator_list)
+    distribution = atlas.lookup(*args) if atlas is not None else None
+    source = 'atlas'
+    if distribution is None:
+        distribution = damage_distribution(*args)
+        source = 'live'
+    return (distribution, *distribution_stats(distribution, 28 - hp), source)
+
+if __name__ == '__main__':
+    import argparse
+    import time
+    parser = argparse.ArgumentParser(description="Build an atlas, or query one and evaluate live what it doesn't cover")
+    commands = parser.add_subparsers(dest='command', required=True)
+    build_parser = commands.add_parser('build')
+    build_parser.add_argument('atlas')
+    build_parser.add_argument('operator_lists', nargs='+')
+    for name in SCENE_AXES:
+        build_parser.add_argument(f"--{name.replace('_', '-')}", type=int, nargs='+')
+    build_parser.add_argument('--workers', type=int, default=1)
+    query_parser = commands.add_parser('query')
+    query_parser.add_argument('atlas')
+    query_parser.add_argument('operator_list')
+    query_parser.add_argument('--deck', type=int, nargs=2, default=[50, 8], metavar=('CARDS', 'CLIMAXES'))
+    query_parser.add_argument('--waiting-room', type=int, nargs=2, default=[0, 0], metavar=('CARDS', 'CLIMAXES'))
+    query_parser.add_argument('--hp', type=int, default=0, help="damage already taken, level * 7 + clock")
+    query_parser.add_argument('--atk', type=int, nargs=2, default=[50, 15], metavar=('CARDS', 'SOULS'))
+    args = parser.parse_args()
+
+    start_time = time.time()
+    if args.command == 'build':
+        grid = {name: getattr(args, name) for name in SCENE_AXES if getattr(args, name) is not None}
+        size = build_atlas(args.atlas, grid, args.operator_lists, workers=args.workers)
+        print(f"{size} entries written to {args.atlas}, time: {time.time() - start_time:.2f} s")
+    else:
+        atlas = Atlas(args.atlas) if os.path.exists(args.atlas) else None
+        distribution, kill_prob, expectation, variance, source = query(*args.deck, *args.waiting_room, args.hp, *args.atk,
+                                                                       args.operator_list, atlas)
+        print(f"Source: {source}, time: {time.time() - start_time:.4f} s")
+        print(f"Kill Probability for threshold {28 - args.hp}: {float(kill_prob):.7f}")
+        print(f"Expected Damage: {float(expectation):.7f}")
+        print(f"Variance: {float(variance):.7f}")
+        for damage, prob in sorted(distribution.items()):
+            print(f"Damage: {damage}, Probability: {float(prob):.7f}")
@@ -0,0 +1,30 @@
+# 测量冷启动时间：核心计算模块不应加载绘图和图形库
+import subprocess
+import sys
+import time
+
+CORE_MODULES = ['utils', 'GameState', 'ProbabilityTree', 'solver']
+HEAVY_MODULES = ['matplotlib', 'networkx', 'pygraphviz', 'numpy']
+REPEAT = 5
+
+def measure(code):
+    '''
+    Best wall time of a fresh interpreter running code, in milliseconds
+    '''
+    best = None
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', code], check=True)
+        elapsed = (time.perf_counter() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+if __name__ == '__main__':
+    baseline = measure('pass')
+    print(f"Interpreter: {baseline:.1f} ms")
+    for module in CORE_MODULES:
+        print(f"import {module}: {measure(f'import {module}') - baseline:.1f} ms")
+
+    check = f"import sys; import {', '.join(CORE_MODULES)}; print([m for m in {HEAVY_MODULES} if m in sys.modules])"
+    loaded = subprocess.run([sys.executable, '-c', check], check=True, capture_output=True, text=True).stdout.strip()
+    print(f"Plotting and graph libraries loaded by the core: {loaded}")
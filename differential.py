@@ -0,0 +1,377 @@
+# 差分验证：在随机场景上运行所有计算引擎，与精确的 Fraction 引擎比对
+import argparse
+import contextlib
+import io
+import math
+import random
+from fractions import Fraction
+from GameState import Player, atkPlayer, GameState, set_fast_kernels
+from ProbabilityTree import ProbabilityTree, LayerCache, SuffixTable
+from solver import Solver
+from markov import MarkovChain
+from utils import Operator, parse_operator, max_damage, define_effect
+
+OPERATOR_FORMATS = ['{}', '{}t', 'moka({})', 'michiru({})', 'woody({})']
+SAMPLES = 4000
+PRUNE_MASS = 0.01
+HYBRID_CUTOFF = 0.01
+
+# The built-in operators written as declared effects
+define_effect('check_michiru', [('mill', 'n'), ('damage', 'climax')])
+define_effect('check_woody', [('look', 'n'), ('shuffle',), ('clock', 'climax')])
+DECLARED = {Operator.MICHIRU: 'check_michiru', Operator.WOODY: 'check_woody'}
+define_effect('peek_shuffle_hit', [('look', 'n'), ('shuffle',), ('damage', 'climax')])
+# Effects the state can't follow, define_effect must reject them
+REJECTED_EFFECTS = [
+    # The looked climax would stay on top and cancel the damage, the state doesn't keep the looked cards
+    ('peek_hit', [('look', 'n'), ('damage', 'climax')]),
+    ('peek', [('look', 'n')]),
+]
+
+# Fixed scenes the random ones rarely reach, with the histogram of the exact engine
+REGRESSIONS = [
+    # michiru empties the deck, the refresh levels up to level 4 and empties the new deck again
+    ({'deck': (1, 0), 'waiting_room': (1, 0), 'level': (3, 0), 'clock': (5, 0), 'atk': (2, 0), 'operators': ['michiru(3)']}, {3: 1}),
+    ({'deck': (1, 0), 'waiting_room': (1, 0), 'level': (2, 0), 'clock': (6, 0), 'atk': (2, 0), 'operators': ['michiru(3)']}, {2: 1}),
+    # woody shuffles the non-climax cards moka left known on top, matches a card by card simulation
+    ({'deck': (12, 3), 'waiting_room': (10, 2), 'level': (0, 0), 'clock': (0, 0), 'atk': (20, 5), 'operators': ['moka(3)', 'woody(2)', '2']},
+     {0: Fraction(1104, 3025), 1: Fraction(3, 1100), 2: Fraction(7519, 12100), 3: Fraction(3, 275)}),
+    # woody as a declared effect
+    ({'deck': (10, 3), 'waiting_room': (5, 1), 'level': (0, 0), 'clock': (3, 0), 'atk': (10, 2), 'operators': ['check_woody(2)', '2t']},
+     {0: Fraction(2387, 9000), 1: Fraction(2387, 9000), 2: Fraction(1909, 9000), 3: Fraction(1813, 9000), 4: Fraction(469, 9000), 5: Fraction(7, 1800)}),
+    # The looked climax is shuffled back before the damage
+    ({'deck': (10, 5), 'waiting_room': (10, 2), 'level': (0, 0), 'clock': (0, 0), 'atk': (10, 0), 'operators': ['peek_shuffle_hit(1)']},
+     {0: Fraction(3, 4), 1: Fraction(1, 4)}),
+]
+
+def random_scenario(rng, max_operators=4):
+    '''
+    Random valid scene, a dict of (cards, climaxes) areas and operator strings
+    '''
+    deck = rng.randint(1, 30)
+    waiting_room = rng.randint(0, 15)
+    level = rng.randint(0, 3)
+    clock = rng.randint(0, 6)
+    atk = rng.randint(1, 40)
+    operators = []
+    for _ in range(rng.randint(1, max_operators)):
+        operators.append(rng.choice(OPERATOR_FORMATS).format(rng.randint(1, 4)))
+    return {
+        'deck': (deck, rng.randint(0, min(deck, 8))),
+        'waiting_room': (waiting_room, rng.randint(0, min(waiting_room, 4))),
+        'level': (level, rng.randint(0, level)),
+        'clock': (clock, rng.randint(0, clock)),
+        'atk': (atk, rng.randint(0, atk)),
+        'operators': operators,
+    }
+
+def scenario_str(scenario):
+    return (f"deck={scenario['deck']} waiting_room={scenario['waiting_room']} level={scenario['level']} "
+            f"clock={scenario['clock']} atk={scenario['atk']} operators={' '.join(scenario['operators'])}")
+
+def scenario_size(scenario):
+    return sum(sum(scenario[area]) for area in ('deck', 'waiting_room', 'level', 'clock', 'atk')) + \
+           sum(parse_operator(op)[1] + 1 for op in scenario['operators'])
+
+def build_state(scenario):
+    player = Player(scenario['deck'], scenario['waiting_room'], scenario['level'], scenario['clock'])
+    return GameState(player, atkPlayer(scenario['atk']), 1)
+
+def summary(result):
+    '''
+    (histogram, kill probability, expectation) from the output of calculate_probabilities
+    '''
+    histogram, kill_prob, expectation, _ = result
+    return histogram, kill_prob, expectation
+
+def run_exact(scenario, operator_list, threshold):
+    return summary(ProbabilityTree(build_state(scenario), operator_list).calculate_probabilities(threshold))
+
+def run_step_kernels(scenario, operator_list, threshold):
+    set_fast_kernels(False)
+    try:
+        tree = ProbabilityTree(build_state(scenario), operator_list, lump=False)
+        return summary(tree.calculate_probabilities(threshold))
+    finally:
+        set_fast_kernels(True)
+
+def run_no_lump(scenario, operator_list, threshold):
+    return summary(ProbabilityTree(build_state(scenario), operator_list, lump=False).calculate_probabilities(threshold))
+
+def run_out_of_core(scenario, operator_list, threshold):
+    tree = ProbabilityTree(build_state(scenario), operator_list, max_layer_states=3)
+    return summary(tree.calculate_probabilities(threshold))
+
+def run_threads(scenario, operator_list, threshold):
+    return summary(ProbabilityTree(build_state(scenario), operator_list, threads=3).calculate_probabilities(threshold))
+
+def run_layer_cache(scenario, operator_list, threshold, lump=True):
+    # Fill the cache with the list without its last operator, then with a tree sharing every operator but the last one
+    cache = LayerCache()
+    last_type, last_num = operator_list[-1]
+    other = operator_list[:-1] + [(Operator.DAMAGE, 1) if last_type == Operator.EFFECT else (last_type, last_num + 1)]
+    for prefix in (operator_list[:-1], other):
+        if not prefix:
+            continue
+        try:
+            ProbabilityTree(build_state(scenario), prefix, layer_cache=cache, lump=lump).calculate_probabilities(threshold)
+        except ValueError:
+            # The stronger last operator can run out of cards, the prefix layers are cached anyway
+            pass
+    return summary(ProbabilityTree(build_state(scenario), operator_list, layer_cache=cache, lump=lump).calculate_probabilities(threshold))
+
+def run_layer_cache_no_lump(scenario, operator_list, threshold):
+    return run_layer_cache(scenario, operator_list, threshold, lump=False)
+
+def run_backward(scenario, operator_list, threshold):
+    # Fill the table with the suffix shared with a shorter list first
+    table = SuffixTable()
+    ProbabilityTree(build_state(scenario), operator_list[1:], suffix_table=table).calculate_backward(threshold)
+    return summary(ProbabilityTree(build_state(scenario), operator_list, suffix_table=table).calculate_backward(threshold))
+
+def run_kill_only(scenario, operator_list, threshold):
+    return None, ProbabilityTree(build_state(scenario), operator_list).calculate_kill_probability(threshold), None
+
+def run_bounds(scenario, operator_list, threshold):
+    # Expanded to the end, the bounds must close on the exact values
+    bounds = ProbabilityTree(build_state(scenario), operator_list).calculate_bounds(threshold, 0, 0)
+    if bounds['kill_low'] != bounds['kill_high'] or bounds['expectation_low'] != bounds['expectation_high']:
+        return None, (bounds['kill_low'], bounds['kill_high']), (bounds['expectation_low'], bounds['expectation_high'])
+    return None, bounds['kill_low'], bounds['expectation_low']
+
+def run_full_beam(scenario, operator_list, threshold):
+    # Pruned code path with a beam that never drops a state
+    tree = ProbabilityTree(build_state(scenario), operator_list, prune_max_states=10 ** 9)
+    return summary(tree.calculate_probabilities(threshold))
+
+def run_solver(scenario, operator_list, threshold):
+    # A single group has a single order, the solver must agree with the tree
+    with contextlib.redirect_stdout(io.StringIO()):
+        solver = Solver(build_state(scenario), [tuple(operator_list)])
+    solver.solve()
+    return summary(solver.calculate_probabilities(threshold))
+
+def run_pruned(scenario, operator_list, threshold):
+    tree = ProbabilityTree(build_state(scenario), operator_list, prune_mass=PRUNE_MASS)
+    histogram, kill_prob, expectation = summary(tree.calculate_probabilities(threshold))
+    return histogram, kill_prob, expectation, tree.pruned_probability
+
+def run_sampling(scenario, operator_list, threshold):
+    tree = ProbabilityTree(build_state(scenario), operator_list)
+    return summary(tree.sample(SAMPLES, threshold, seed=0))
+
+def run_hybrid(scenario, operator_list, threshold):
+    tree = ProbabilityTree(build_state(scenario), operator_list)
+    histogram, kill_prob, expectation = summary(tree.calculate_hybrid(threshold, HYBRID_CUTOFF, SAMPLES, seed=0))
+    return histogram, kill_prob, expectation, tree
+
+def run_effects(scenario, operator_list, threshold):
+    operator_list = [(Operator.EFFECT, (DECLARED[op[0]], op[1])) if op[0] in DECLARED else op for op in operator_list]
+    return summary(ProbabilityTree(build_state(scenario), operator_list).calculate_probabilities(threshold))
+
+def run_markov(scenario, operator_list, threshold):
+    state = build_state(scenario)
+    return summary(MarkovChain([state], operator_list).evaluate([state])[0].summary(threshold))
+
+def pruned_tolerance(reference, result, operator_list):
+    # Every dropped state moves at most its mass, twice with the rescaling
+    mass = 2 * float(result[3])
+    span = sum(max_damage(op) for op in operator_list) + 8
+    return mass + 1e-12, mass * span + 1e-12
+
+def sampling_tolerance(reference, result, operator_list):
+    # Five standard errors
+    histogram, kill_prob, expectation = reference
+    variance = sum((damage - expectation) ** 2 * prob for damage, prob in histogram.items())
+    kill_prob = float(kill_prob)
+    return 5 * math.sqrt(kill_prob * (1 - kill_prob) / SAMPLES) + 1e-9, 5 * math.sqrt(float(variance) / SAMPLES) + 1e-9
+
+def float_tolerance(reference, result, operator_list):
+    return 1e-9, 1e-9
+
+def hybrid_tolerance(reference, result, operator_list):
+    # Five standard errors of the sampled mass, at least the worst case of a Bernoulli draw
+    tree = result[3]
+    floor = tree.sampled_probability * 0.5 / math.sqrt(SAMPLES)
+    return 5 * max(tree.kill_error, floor) + 1e-9, 5 * max(tree.expectation_error, floor) + 1e-9
+
+# name: (engine, tolerance), engines with no tolerance must agree exactly
+ENGINES = {
+    'step_kernels': (run_step_kernels, None),
+    'no_lump': (run_no_lump, None),
+    'out_of_core': (run_out_of_core, None),
+    'threads': (run_threads, None),
+    'layer_cache': (run_layer_cache, None),
+    'layer_cache_no_lump': (run_layer_cache_no_lump, None),
+    'backward': (run_backward, None),
+    'kill_only': (run_kill_only, None),
+    'bounds': (run_bounds, None),
+    'full_beam': (run_full_beam, None),
+    'solver': (run_solver, None),
+    'effects': (run_effects, None),
+    'markov': (run_markov, float_tolerance),
+    'pruned': (run_pruned, pruned_tolerance),
+    'sampling': (run_sampling, sampling_tolerance),
+    'hybrid': (run_hybrid, hybrid_tolerance),
+}
+
+def compare(reference, result, tolerance, operator_list):
+    '''
+    Return: None if the result agrees with the reference, the reason otherwise
+    '''
+    histogram, kill_prob, expectation = reference
+    if tolerance is None:
+        if result[0] is not None and result[0] != histogram:
+            return f"histogram {result[0]} != {histogram}"
+        if result[1] != kill_prob:
+            return f"kill probability {result[1]} != {kill_prob}"
+        if result[2] is not None and result[2] != expectation:
+            return f"expectation {result[2]} != {expectation}"
+        return None
+
+    kill_tol, expectation_tol = tolerance(reference, result, operator_list)
+    if result[0] is not None and not set(result[0]) <= set(histogram):
+        return f"impossible damage {sorted(set(result[0]) - set(histogram))}"
+    if abs(float(result[1]) - float(kill_prob)) > kill_tol:
+        return f"kill probability {float(result[1]):.6f} != {float(kill_prob):.6f} (tolerance {kill_tol:.6f})"
+    if abs(float(result[2]) - float(expectation)) > expectation_tol:
+        return f"expectation {float(result[2]):.6f} != {float(expectation):.6f} (tolerance {expectation_tol:.6f})"
+    return None
+
+def check(scenario, engines):
+    '''
+    Run the engines on a scene
+    Return: None if the scene is not valid (the exact engine rejects it), else list of (engine, reason) failures
+    '''
+    operator_list = [parse_operator(op) for op in scenario['operators']]
+    threshold = 28 - build_state(scenario).hp()
+    try:
+        reference = run_exact(scenario, operator_list, threshold)
+    except ValueError:
+        return None
+
+    failures = []
+    for name in engines:
+        engine, tolerance = ENGINES[name]
+        try:
+            reason = compare(reference, engine(scenario, operator_list, threshold), tolerance, operator_list)
+        except Exception as e:
+            reason = f"{type(e).__name__}: {e}"
+        if reason is not None:
+            failures.append((name, reason))
+    return failures
+
+def check_regressions(engines):
+    '''
+    Run the engines on the scenes of REGRESSIONS, the exact engine must give the recorded histogram
+    Return: list of (engine, scene, reason) failures
+    '''
+    failures = []
+    for scenario, histogram in REGRESSIONS:
+        operator_list = [parse_operator(op) for op in scenario['operators']]
+        try:
+            result = run_exact(scenario, operator_list, 28 - build_state(scenario).hp())[0]
+            reason = None if result == histogram else f"histogram {result} != {histogram}"
+        except Exception as e:
+            reason = f"{type(e).__name__}: {e}"
+        if reason is not None:
+            failures.append(('exact', scenario, reason))
+            continue
+        failures.extend((name, scenario, reason) for name, reason in check(scenario, engines))
+    return failures
+
+def check_rejected_effects():
+    '''
+    Return: names of REJECTED_EFFECTS that define_effect accepts
+    '''
+    accepted = []
+    for name, steps in REJECTED_EFFECTS:
+        try:
+            define_effect(name, steps)
+        except ValueError:
+            continue
+        accepted.append(name)
+    return accepted
+
+def smaller_scenarios(scenario):
+    '''
+    Scenes one step smaller than scenario: an operator removed or weakened, or an area with one card less
+    '''
+    operators = scenario['operators']
+    if len(operators) > 1:
+        for i in range(len(operators)):
+            yield dict(scenario, operators=operators[:i] + operators[i + 1:])
+    for i, op in enumerate(operators):
+        num = parse_operator(op)[1]
+        if num > 1:
+            yield dict(scenario, operators=operators[:i] + [op.replace(str(num), str(num - 1))] + operators[i + 1:])
+    for area in ('deck', 'waiting_room', 'level', 'clock', 'atk'):
+        cards, climaxes = scenario[area]
+        if climaxes > 0:
+            yield dict(scenario, **{area: (cards, climaxes - 1)})
+        if cards > max(climaxes, 1 if area in ('deck', 'atk') else 0):
+            yield dict(scenario, **{area: (cards - 1, climaxes)})
+
+def shrink(scenario, name):
+    '''
+    Greedily reduce a scene while the engine still fails on it
+    '''
+    reduced = True
+    while reduced:
+        reduced = False
+        for candidate in smaller_scenarios(scenario):
+            failures = check(candidate, [name])
+            if failures:
+                scenario = candidate
+                reduced = True
+                break
+    return scenario
+
+def validate(runs=100, seed=0, engines=None, max_operators=4, verbose=False):
+    '''
+    Check the engines on runs random scenes
+    Return: dict(engine: smallest failing scene), empty if every engine agrees
+    '''
+    if engines is None:
+        engines = list(ENGINES)
+    rng = random.Random(seed)
+    smallest = {}
+    checked = 0
+    for _ in range(runs):
+        scenario = random_scenario(rng, max_operators)
+        failures = check(scenario, engines)
+        if failures is None:
+            continue
+        checked += 1
+        for name, reason in failures:
+            if verbose:
+                print(f"{name} failed: {reason}\n    {scenario_str(scenario)}")
+            if name not in smallest or scenario_size(scenario) < scenario_size(smallest[name]):
+                smallest[name] = scenario
+    print(f"Checked {checked} valid scenes out of {runs}")
+
+    for name in list(smallest):
+        smallest[name] = shrink(smallest[name], name)
+        reason = check(smallest[name], [name])[0][1]
+        print(f"{name} FAILED: {reason}\n    smallest scene: {scenario_str(smallest[name])}")
+    for name, scenario, reason in check_regressions(engines):
+        print(f"{name} FAILED on a regression scene: {reason}\n    {scenario_str(scenario)}")
+        smallest.setdefault(name, scenario)
+    for name in check_rejected_effects():
+        print(f"effects FAILED: define_effect accepts {name}, whose steps the state can't follow")
+        smallest.setdefault('effects', None)
+    for name in engines:
+        if name not in smallest:
+            print(f"{name}: ok")
+    return smallest
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Differential validation of the evaluation engines")
+    parser.add_argument('--runs', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--max-operators', type=int, default=4)
+    parser.add_argument('--engines', nargs='*', choices=list(ENGINES), default=None)
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+    failed = validate(args.runs, args.seed, args.engines, args.max_operators, args.verbose)
+    raise SystemExit(1 if failed else 0)
@@ -1,20 +1,52 @@
 import tkinter as tk
 from tkinter import font as tkfont  # 用于字体设置
 from tkinter import ttk
-import matplotlib.pyplot as plt
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+import os
 from GameState import Player, atkPlayer, GameState
-from ProbabilityTree import ProbabilityTree
+from ProbabilityTree import ProbabilityTree, LayerCache, SuffixTable
 # Accurate time measurement
 import time
 import itertools
-from solver import Solver
+from solver import Solver, SequenceRanker
+from atlas import Atlas, distribution_stats
 
-from utils import to_str_list, parse_operator_group
+from utils import to_str_list, to_str_group, parse_operator_group
 
 DEBUG = False
 CURVES_MEMORY = []
 TMP_CURVE = []
+# Intermediate layers of recent runs, reused when only the end of the operator list is edited
+LAYER_CACHE = LayerCache()
+# Damage distributions of (state, remaining operators), filled by the best sequence search
+# and reused by the other buttons whenever they start from a state it has seen
+SUFFIX_TABLE = SuffixTable()
+# Precomputed distributions built with atlas.py, they are floats so they only answer in Decimal mode
+ATLAS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'atlas.bin')
+ATLAS = None
+if os.path.exists(ATLAS_PATH):
+    try:
+        ATLAS = Atlas(ATLAS_PATH)
+    except ValueError as e:
+        # Built with older kernels, everything is evaluated live until it is built again
+        print(e)
+# matplotlib is slow to import, it is loaded after the window shows up, see init_plot
+plt = None
+fig = None
+canvas = None
+
+def init_plot():
+    global plt, fig, canvas
+    if fig is not None:
+        return
+    import matplotlib.pyplot as pyplot
+    from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+    
+    # Setup right frame for plot
+    plt = pyplot
+    fig, _ = plt.subplots()
+    canvas = FigureCanvasTkAgg(fig, master=right_frame)
+    canvas_widget = canvas.get_tk_widget()
+    canvas_widget.pack(fill=tk.BOTH, expand=True)
 
 def get_operator_list():
     try:
@@ -65,13 +97,27 @@ def calculate():
     entry_threshold.delete(0, tk.END)
     entry_threshold.insert(0, str(threshold))  # Display calculated threshold
 
-    probability_tree = ProbabilityTree(initial_state, operator_list)
-    result_dict, kill_prob, expectation, variance = probability_tree.calculate_probabilities(threshold)
+    result_dict = None
+    source = 'live'
+    # The atlas only holds scenes without climaxes in level and clock
+    if level[1] == 0 and clock[1] == 0 and clock[0] < 7:
+        result_dict = atlas_lookup(deck, waiting_room, initial_state.hp(), atk)
+    if result_dict is not None:
+        source = 'atlas'
+        kill_prob, expectation, variance = distribution_stats(result_dict, threshold)
+    else:
+        probability_tree = ProbabilityTree(initial_state, operator_list, LAYER_CACHE, suffix_table=SUFFIX_TABLE)
+        if probability_tree.has_backward():
+            result_dict, kill_prob, expectation, variance = probability_tree.calculate_backward(threshold)
+        else:
+            result_dict, kill_prob, expectation, variance = probability_tree.calculate_probabilities(threshold)
     end_time = time.time()
     
     # Update GUI with results
     text_result.delete('1.0', tk.END)
     text_result.insert(tk.END, f"Time taken: {end_time - start_time} seconds\n")
+    if ATLAS is not None:
+        text_result.insert(tk.END, f"Source: {source}\n")
     # Print operator list
     text_result.insert(tk.END, f"Operator List: {to_str_list(operator_list)}\n")
     text_result.insert(tk.END, f"Kill Probability for threshold {threshold}: {format_result(kill_prob)}\n")
@@ -82,6 +128,7 @@ def calculate():
         text_result.insert(tk.END, f"Damage: {damage}, Probability: {format_result(prob)}\n")
     
     # Plotting the results
+    init_plot()
     fig.clear()
     labels = list(result_dict.keys())
     values = list(result_dict.values())
@@ -104,23 +151,28 @@ def kill_prob_curve():
     
     operator_list = get_operator_list()
     
-    prob_list = []
     start_time = time.time()
-    no_kill = False
-    for i in range(1, 29):
-        if no_kill:
-            prob_list.append(0)
-            continue
-        hp = 28 - i
-        initial_player = Player(deck, waiting_room, (hp // 7, 0), (hp % 7, 0))
-        initial_atk_player = atkPlayer(atk)
-        initial_state = GameState(initial_player, initial_atk_player, 1)
-        threshold = i
-        probability_tree = ProbabilityTree(initial_state, list(operator_list))
-        _, kill_prob, _, _ = probability_tree.calculate_probabilities(threshold)
-        if kill_prob == 0:
-            no_kill = True
-        prob_list.append(kill_prob)
+    prob_list = atlas_curve(deck, waiting_room, atk)
+    if prob_list is None:
+        prob_list = []
+        no_kill = False
+        for i in range(1, 29):
+            if no_kill:
+                prob_list.append(0)
+                continue
+            hp = 28 - i
+            initial_player = Player(deck, waiting_room, (hp // 7, 0), (hp % 7, 0))
+            initial_atk_player = atkPlayer(atk)
+            initial_state = GameState(initial_player, initial_atk_player, 1)
+            threshold = i
+            probability_tree = ProbabilityTree(initial_state, list(operator_list), LAYER_CACHE, suffix_table=SUFFIX_TABLE)
+            if probability_tree.has_backward():
+                kill_prob = probability_tree.calculate_backward(threshold)[1]
+            else:
+                kill_prob = probability_tree.calculate_kill_probability(threshold)
+            if kill_prob == 0:
+                no_kill = True
+            prob_list.append(kill_prob)
     end_time = time.time()
     text_result.delete('1.0', tk.END)
     text_result.insert(tk.END, f"Time taken: {end_time - start_time} seconds\n")
@@ -130,6 +182,7 @@ def kill_prob_curve():
         
     TMP_CURVE = [(deck, waiting_room, atk, operator_list), prob_list]
     
+    init_plot()
     fig.clear()
     plt.plot(range(1, 29), prob_list)
     # y轴显示为百分比
@@ -149,6 +202,7 @@ def kill_prob_curve():
 def draw_all_curves():
     global CURVES_MEMORY
     # Plot all curves in memory
+    init_plot()
     fig.clear()
     for index, curve in enumerate(CURVES_MEMORY):
         prob_list = curve[1]
@@ -201,6 +255,7 @@ def delete_last_curve():
     global CURVES_MEMORY
     if CURVES_MEMORY != []:
         CURVES_MEMORY.pop()
+    init_plot()
     fig.clear()
     canvas.draw()
     text_result.delete('1.0', tk.END)
@@ -216,7 +271,7 @@ def calculate_best_sequence():
     waiting_room = (int(entry_waiting_room.get()), int(entry_climax_waiting_room.get()))
     atk = (int(entry_atk.get()), int(entry_atk_soul.get()))
 
-    operator_list = get_operator_list()
+    operator_group_list = get_operator_group_list()
 
     initial_player = Player(deck, waiting_room, level, clock)
     initial_atk_player = atkPlayer(atk)
@@ -225,25 +280,21 @@ def calculate_best_sequence():
     entry_threshold.delete(0, tk.END)
     entry_threshold.insert(0, str(threshold))
 
-    sequences = list(itertools.permutations(operator_list))
-    # Delete the repeated sequences
-    sequences = list(set(sequences))
+    # Only the top 3 orderings by expectation, the orderings that can't reach them are skipped
+    ranker = SequenceRanker(initial_state, operator_group_list, threshold, suffix_table=SUFFIX_TABLE)
     results = []
-
-    for seq in sequences:
-        probability_tree = ProbabilityTree(initial_state, list(seq))
-        result_dict, kill_prob, expectation, variance = probability_tree.calculate_probabilities(threshold)
-        results.append((seq, result_dict, expectation, variance, kill_prob))
-
-    # Sort results by expectation in descending order
-    results.sort(key=lambda x: x[2], reverse=True)
+    for seq, distribution in ranker.rank(3):
+        result_dict, kill_prob, expectation, variance = distribution.summary(threshold)
+        results.append((' '.join(to_str_group(ops) for ops in seq), result_dict, expectation, variance, kill_prob))
 
     # Update GUI with sorted results
     text_result.delete('1.0', tk.END)
+    text_result.insert(tk.END, f"Evaluated {ranker.evaluated} of {ranker.total} orderings, skipped {ranker.skipped}\n")
     for seq, _, exp, var, kill_prob in results:
-        text_result.insert(tk.END, f"Sequence: {' '.join(seq)}\nExpectation: {format_result(exp)}, Variance: {format_result(var)}, Kill Probability: {format_result(kill_prob)}\n")
+        text_result.insert(tk.END, f"Sequence: {seq}\nExpectation: {format_result(exp)}, Variance: {format_result(var)}, Kill Probability: {format_result(kill_prob)}\n")
 
     # Plot the results for the top 3 sequences in a combined chart
+    init_plot()
     fig.clear()
     width = 0.25  # bar width
     min_damage = min(min(res[1].keys()) for res in results[:3])
@@ -256,7 +307,7 @@ def calculate_best_sequence():
         # Calculate offsets for each sequence
         offsets = [index - width + i * width for index in x]
         values = [result_dict.get(damage, 0) for damage in range(min_damage, max_damage + 1)]
-        ax.bar(offsets, values, width, label=f"Seq {i+1}: {' '.join(seq)}")
+        ax.bar(offsets, values, width, label=f"Seq {i+1}: {seq}")
 
     ax.set_xlabel('Damage Values')
     ax.set_ylabel('Probability')
@@ -287,7 +338,8 @@ def find_best_strategy():
     entry_threshold.delete(0, tk.END)
     entry_threshold.insert(0, str(threshold))  # Display calculated threshold
 
-    solver = Solver(initial_state, operator_group_list)
+    objective = 'kill' if kill_objective.get() else 'expectation'
+    solver = Solver(initial_state, operator_group_list, objective=objective, threshold=threshold)
     text_result.delete('1.0', tk.END)
     time1 = time.time()
     solver.solve()
@@ -308,6 +360,7 @@ def find_best_strategy():
     
     
     # Plotting the results
+    init_plot()
     fig.clear()
     labels = list(result_dict.keys())
     values = list(result_dict.values())
@@ -319,6 +372,20 @@ def find_best_strategy():
     plt.title('Probability Distribution of Damage Values')
     canvas.draw()
     
+def atlas_lookup(deck, waiting_room, hp, atk):
+    '''
+    Damage distribution from the atlas, None if there is no atlas, the scene is not covered
+    or the results are shown as exact fractions
+    '''
+    if ATLAS is None or display_mode.get() != "Decimal":
+        return None
+    return ATLAS.lookup(*deck, *waiting_room, hp, *atk, entry_operator_list.get())
+
+def atlas_curve(deck, waiting_room, atk):
+    if ATLAS is None or display_mode.get() != "Decimal":
+        return None
+    return ATLAS.kill_curve(*deck, *waiting_room, *atk, entry_operator_list.get())
+
 def format_result(value):
     if display_mode.get() == "Decimal":
         value = float(value)
@@ -463,6 +530,11 @@ button_delete_all_curves.grid(row=11, column=1)
 debug_button = tk.Button(left_frame, text="Find Best Strategy", command=find_best_strategy, font=default_font)
 debug_button.grid(row=10, column=2)
 
+# Find Best Strategy maximizes the kill probability instead of the expected damage
+kill_objective = tk.BooleanVar(value=False)
+cb_kill_objective = tk.Checkbutton(left_frame, text="Maximize Kill", variable=kill_objective, font=default_font)
+cb_kill_objective.grid(row=11, column=2)
+
 # Radio buttons for display mode
 display_mode = tk.StringVar(value="Decimal")  # Default display mode
 rb_decimal = tk.Radiobutton(left_frame, text="Decimal", variable=display_mode, value="Decimal", font=default_font)
@@ -474,10 +546,7 @@ rb_fraction.grid(row=12, column=2, columnspan=2)
 text_result = tk.Text(left_frame, height=20, width=80, font=default_font)
 text_result.grid(row=13, column=0, columnspan=3)
 
-# Setup right frame for plot
-fig, ax = plt.subplots()
-canvas = FigureCanvasTkAgg(fig, master=right_frame)
-canvas_widget = canvas.get_tk_widget()
-canvas_widget.pack(fill=tk.BOTH, expand=True)
+# Load the plot once the window is shown
+root.after(100, init_plot)
 
 root.mainloop()
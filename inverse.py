@@ -0,0 +1,113 @@
+# 反向查询：斩杀率随剩余血量/高潮数/魂数单调变化，用二分或倍增搜索找出越过目标斩杀率的位置
+from functools import lru_cache
+from GameState import Player, atkPlayer, GameState
+from ProbabilityTree import ProbabilityTree
+from sweep import DEFAULTS
+from utils import parse_operator_list
+
+@lru_cache(maxsize=None)
+def kill_probability(deck, deck_climax, waiting_room, waiting_room_climax, hp, atk, atk_soul, operator_list):
+    '''
+    Kill probability of the scene with threshold 28 - hp, cached so that repeated
+    queries on the same scene don't evaluate a point twice
+    '''
+    initial_player = Player((deck, deck_climax), (waiting_room, waiting_room_climax), (hp // 7, 0), (hp % 7, 0))
+    initial_state = GameState(initial_player, atkPlayer((atk, atk_soul)), 1)
+    return ProbabilityTree(initial_state, parse_operator_list(operator_list)).calculate_kill_probability(28 - hp)
+
+def find_crossing(f, low, high, target, increasing, start=None):
+    '''
+    Search a monotone function on the integers of [low, high] for the edge of f(x) >= target
+    increasing: f grows with x, the smallest x reaching target is returned, otherwise the largest
+    start: optional guess, the search gallops away from it with steps 1, 2, 4... to bracket
+    the edge before the bisection, which is cheaper than bisecting the whole range when the
+    guess is close
+    If f is not monotone (a few more souls can also mean a few more cancels), x is still a
+    point where f crosses target, but not necessarily the first one
+    Return: (x, f(x), number of evaluations), x is None if no point reaches target
+    '''
+    values = {}
+    def reaches(x):
+        if x not in values:
+            values[x] = f(x)
+        return values[x] >= target
+
+    # Bracket the edge: good is a point reaching target, bad one that doesn't, the edge is between them
+    good, bad = None, None
+    if start is None:
+        good, bad = (high, low - 1) if increasing else (low, high + 1)
+        if not reaches(good):
+            return None, values[good], len(values)
+    else:
+        start = min(max(start, low), high)
+        # Moving away from the target side makes the point worse
+        worse = -1 if increasing else 1
+        step = 1
+        if reaches(start):
+            good = start
+            x = start + worse * step
+            while low <= x <= high and reaches(x):
+                good = x
+                step *= 2
+                x = start + worse * step
+            bad = x if low <= x <= high else (low - 1 if increasing else high + 1)
+        else:
+            bad = start
+            x = start - worse * step
+            while low <= x <= high and not reaches(x):
+                bad = x
+                step *= 2
+                x = start - worse * step
+            if not low <= x <= high:
+                edge = high if increasing else low
+                if not reaches(edge):
+                    return None, values[edge], len(values)
+                x = edge
+            good = x
+
+    while abs(good - bad) > 1:
+        middle = (good + bad) // 2
+        if reaches(middle):
+            good = middle
+        else:
+            bad = middle
+    return good, values[good], len(values)
+
+def scene(params):
+    scene_params = dict(DEFAULTS)
+    scene_params.update(params)
+    if 'operator_list' not in scene_params:
+        raise ValueError("The query needs an operator list")
+    return scene_params
+
+def evaluate(params, **changes):
+    params = dict(params, **changes)
+    return kill_probability(params['deck'], params['deck_climax'], params['waiting_room'], params['waiting_room_climax'],
+                            params['hp'], params['atk'], params['atk_soul'], params['operator_list'])
+
+def max_remaining_hp_for_kill(params, target, start=None):
+    '''
+    Highest remaining HP (1 to 28, that is 28 - hp like the kill probability curve) at which
+    the scene kills with probability at least target
+    params: dict like sweep.evaluate_point, missing values use sweep.DEFAULTS, hp is ignored
+    start: optional guess of the answer, see find_crossing
+    Return: (remaining HP, kill probability, number of evaluations), None if even 1 HP doesn't reach target
+    '''
+    params = scene(params)
+    return find_crossing(lambda remaining: evaluate(params, hp=28 - remaining), 1, 28, target, increasing=False, start=start)
+
+def max_climax_for_kill(params, target, start=None):
+    '''
+    Most climaxes left in the deck with which the scene still kills with probability at least target
+    Return: (number of climaxes, kill probability, number of evaluations)
+    '''
+    params = scene(params)
+    return find_crossing(lambda climax: evaluate(params, deck_climax=climax), 0, params['deck'], target, increasing=False, start=start)
+
+def min_soul_for_kill(params, target, start=None):
+    '''
+    Fewest souls in the attacker deck with which the scene kills with probability at least target
+    Return: (number of souls, kill probability, number of evaluations)
+    '''
+    params = scene(params)
+    return find_crossing(lambda soul: evaluate(params, atk_soul=soul), 0, params['atk'], target, increasing=True, start=start)
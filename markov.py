@@ -0,0 +1,153 @@
+# 马尔可夫链：每个操作对应一个稀疏转移矩阵，一批初始分布的计算变成一串稀疏矩阵乘法
+import hashlib
+import os
+import pickle
+import numpy as np
+import scipy.sparse as sp
+from GameState import Player, atkPlayer, GameState, KERNEL_VERSION
+from ProbabilityTree import ProbabilityTree, DamageDistribution
+from utils import cache_str
+
+# Version of the pickled MarkovChain, bump it when its attributes change
+CHAIN_FORMAT = 1
+
+def state_key(state):
+    '''
+    Row or column of a state, terminal states only keep their hp, nothing happens to them anymore
+    '''
+    if state.is_terminal():
+        return ('terminal', state.hp())
+    return (state.player.key(), state.atk_player.deck)
+
+def key_state(key):
+    player_key, atk_deck = key
+    return GameState(Player.from_key(player_key), atkPlayer(atk_deck), 1)
+
+def key_hp(key):
+    if key[0] == 'terminal':
+        return key[1]
+    level, clock = key[0][2], key[0][3]
+    return level[0] * 7 + clock[0]
+
+class MarkovChain:
+    def __init__(self, start_states, operator_list, lump=True):
+        '''
+        The reachable states of start_states under operator_list, one sparse stochastic
+        matrix per operator: matrices[i][a, b] is the probability of moving from states[i][a]
+        to states[i + 1][b]. Any batch of distributions over the start states is then
+        evaluated with one chain of sparse products, see evaluate
+        Probabilities are floats, the exact engines are ProbabilityTree and Solver
+        lump: states are lumped like ProbabilityTree.lump_state, fewer columns
+        '''
+        start_states = list(start_states)
+        self.operator_list = list(operator_list)
+        self.lump = lump
+        signatures = ProbabilityTree(start_states[0], self.operator_list).get_lump_signatures() if lump else None
+
+        layer = list(dict.fromkeys(state_key(state) for state in start_states))
+        self.states = [layer]
+        self.matrices = []
+        for i, operator in enumerate(self.operator_list):
+            index = {}
+            rows, cols, values = [], [], []
+            for row, key in enumerate(layer):
+                if key[0] == 'terminal':
+                    transitions = [(key, 1)]
+                else:
+                    transitions = []
+                    for state in key_state(key).execute(operator):
+                        if lump and not state.is_terminal():
+                            state = ProbabilityTree.lump_to(state, *signatures[i])
+                        transitions.append((state_key(state), state.probability))
+                for next_key, probability in transitions:
+                    col = index.setdefault(next_key, len(index))
+                    rows.append(row)
+                    cols.append(col)
+                    values.append(float(probability))
+            layer = list(index)
+            # Duplicate (row, col) pairs are summed by the conversion
+            self.matrices.append(sp.coo_matrix((values, (rows, cols)), shape=(len(self.states[-1]), len(layer))).tocsr())
+            self.states.append(layer)
+        self.start_index = {key: row for row, key in enumerate(self.states[0])}
+        self.final_hp = np.array([key_hp(key) for key in self.states[-1]])
+
+    def __len__(self):
+        return sum(len(layer) for layer in self.states)
+
+    def covers(self, state):
+        return state_key(state) in self.start_index
+
+    def evaluate(self, starts):
+        '''
+        starts: list of rows, a row is a start state or a list of (start state, weight),
+        the states of a row must have the same hp, the damage is counted from it
+        Return: list of DamageDistribution with float probabilities, one per row
+        '''
+        rows, cols, values, start_hp = [], [], [], []
+        for row, start in enumerate(starts):
+            if isinstance(start, GameState):
+                start = [(start, 1)]
+            hps = set(state.hp() for state, _ in start)
+            if len(hps) != 1:
+                raise ValueError(f"The start states of a row must have the same hp, got {sorted(hps)}")
+            start_hp.append(hps.pop())
+            for state, weight in start:
+                key = state_key(state)
+                if key not in self.start_index:
+                    raise ValueError(f"{state} is not a start state of the chain")
+                rows.append(row)
+                cols.append(self.start_index[key])
+                values.append(float(weight) * float(state.probability))
+
+        batch = sp.csr_matrix((values, (rows, cols)), shape=(len(starts), len(self.states[0])))
+        for matrix in self.matrices:
+            batch = batch @ matrix
+        batch = batch.tocoo()
+
+        results = [{} for _ in starts]
+        for row, col, probability in zip(batch.row, batch.col, batch.data):
+            damage = int(self.final_hp[col]) - start_hp[row]
+            results[row][damage] = results[row].get(damage, 0) + float(probability)
+        return [DamageDistribution(result) for result in results]
+
+    def save(self, path):
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def load(path):
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
+def cached_chain(start_states, operator_list, directory, lump=True):
+    '''
+    MarkovChain of start_states and operator_list, loaded from directory if it was built before
+    The file name hashes the kernel version, the chain format and the steps of the effects,
+    a chain built with other kernels or another definition of an effect is built again
+    '''
+    start_keys = sorted(set(state_key(state) for state in start_states), key=repr)
+    name = repr((KERNEL_VERSION, CHAIN_FORMAT, start_keys, [cache_str(operator) for operator in operator_list], lump))
+    path = os.path.join(directory, f"chain_{hashlib.sha1(name.encode('utf-8')).hexdigest()}.pkl")
+    if os.path.exists(path):
+        return MarkovChain.load(path)
+    chain = MarkovChain(start_states, operator_list, lump)
+    os.makedirs(directory, exist_ok=True)
+    chain.save(path)
+    return chain
+
+def kill_curve(deck, waiting_room, atk, operator_list, directory=None):
+    '''
+    Kill probability at remaining HP 1 to 28 like the GUI curve, the 28 starts are one batch
+    directory: optional cache of the chain
+    '''
+    starts = []
+    for remaining in range(1, 29):
+        hp = 28 - remaining
+        starts.append(GameState(Player(deck, waiting_room, (hp // 7, 0), (hp % 7, 0)), atkPlayer(atk), 1))
+    if directory is None:
+        chain = MarkovChain(starts, operator_list)
+    else:
+        chain = cached_chain(starts, operator_list, directory)
+    return [distribution.kill_probability(remaining) for remaining, distribution in zip(range(1, 29), chain.evaluate(starts))]
@@ -1,12 +1,35 @@
 # 用枚举找出最优攻击策略，时间复杂度极大，仅用于三种操作的情况
-import networkx as nx
-import matplotlib.pyplot as plt
-from networkx.drawing.nx_agraph import graphviz_layout
-from utils import parse_operator, to_str_group
+import heapq
+import os
+from concurrent.futures import ProcessPoolExecutor
+from utils import Operator, parse_operator, to_str_group, max_cards, max_damage, effect_definitions, load_effects
+from GameState import GameState
+from ProbabilityTree import ProbabilityTree, DamageDistribution, SuffixTable, mixture_roots
+
+def count_prefixes(group_counts, length):
+    '''
+    Number of distinct ordered choices of length groups from the multiset group_counts
+    '''
+    if length == 0:
+        return 1
+    total = 0
+    for i, times in enumerate(group_counts):
+        if times > 0:
+            rest = list(group_counts)
+            rest[i] -= 1
+            total += count_prefixes(tuple(rest), length - 1)
+    return total
 
 class solver_node:
-    def __init__(self, state, root_hp, operator_group_dict, last_op, parent, score=None, level=0):
+    def __init__(self, state, root_hp, operator_group_dict, last_op, parent, score=None, level=0, prune_mass=0, threshold=None,
+                 mixture=None):
+        '''
+        threshold: None to maximize the expected damage, otherwise the kill probability at threshold
+        mixture: for the root, the list of possible initial states weighted by their probability,
+        the first group is chosen without knowing which one it is
+        '''
         self.state = state
+        self.mixture = mixture
         self.root_hp = root_hp
         self.operator_group_dict = operator_group_dict
         self.last_op = last_op
@@ -16,6 +39,9 @@ class solver_node:
         self.best_children_group = None
         self.level = level
         self.id = None
+        self.prune_mass = prune_mass
+        self.threshold = threshold
+        self.absorbed = None
     
     def build_children(self):
         if self.is_leaf():
@@ -24,7 +50,7 @@ class solver_node:
         self.children_groups = []
         for ops, times in self.operator_group_dict.items():
             children = []
-            last_states = {self.state:self.state}
+            last_states = {state: state for state in self.leaf_states()}
             for op in ops:
                 next_states = {}
                 for state in last_states.values():
@@ -39,12 +65,53 @@ class solver_node:
                 ops_remains[ops] -= 1
             else:
                 del ops_remains[ops]
-            for state in last_states.values():
-                children.append(solver_node(state, self.root_hp, ops_remains, ops, self, level=self.level + 1))
+            states = list(last_states.values())
+            if self.prune_mass > 0:
+                states = self.prune(states)
+            for state in states:
+                children.append(solver_node(state, self.root_hp, ops_remains, ops, self, level=self.level + 1,
+                                            prune_mass=self.prune_mass, threshold=self.threshold))
             self.children_groups.append(children)
     
+    def prune(self, states):
+        '''
+        Drop the least likely child states, up to prune_mass of their total probability,
+        the remaining states are scaled up to keep the total
+        '''
+        states = sorted(states, key=lambda x: x.probability, reverse=True)
+        tot_prob = sum(s.probability for s in states)
+        p = 0
+        while len(states) > 1 and p + states[-1].probability <= self.prune_mass * tot_prob:
+            p += states.pop().probability
+        if p > 0:
+            scale = tot_prob / (tot_prob - p)
+            for s in states:
+                s.set_probability(s.probability * scale)
+        return states
+    
     def is_leaf(self):
-        return self.operator_group_dict == {} or self.state.is_terminal()
+        if self.mixture is not None:
+            return self.operator_group_dict == {}
+        return self.operator_group_dict == {} or self.state.is_terminal() or self.is_absorbed()
+    
+    def leaf_states(self):
+        return self.mixture if self.mixture is not None else [self.state]
+    
+    def is_absorbed(self):
+        '''
+        With a threshold, a state that already dealt it, or that can't deal it even if every
+        remaining group deals its maximum damage, has a known value and is not expanded
+        '''
+        if self.absorbed is None:
+            if self.threshold is None or self.mixture is not None:
+                self.absorbed = False
+            else:
+                dealt = self.state.hp() - self.root_hp
+                damage = sum(max_damage(op) * times for ops, times in self.operator_group_dict.items() for op in ops)
+                cards = sum(max_cards(op) * times for ops, times in self.operator_group_dict.items() for op in ops)
+                self.absorbed = dealt >= self.threshold or \
+                                dealt + ProbabilityTree.damage_bound(self.state, damage, cards) < self.threshold
+        return self.absorbed
     
     def is_root(self):
         return self.parent is None
@@ -54,7 +121,12 @@ class solver_node:
             return self.score
         
         if self.is_leaf():
-            self.score = (self.state.hp() - self.root_hp) * self.state.probability
+            self.score = 0
+            for state in self.leaf_states():
+                if self.threshold is None:
+                    self.score += (state.hp() - self.root_hp) * state.probability
+                elif state.hp() - self.root_hp >= self.threshold:
+                    self.score += state.probability
             return self.score
         
         if self.children_groups is None:
@@ -70,21 +142,148 @@ class solver_node:
                 break
         return self.score
 
+def solve_subtree(args):
+    '''
+    Worker entry of Solver.solve_parallel, score a frontier node in another process
+    Return: (score, best children group), the best response subtree of the node
+    '''
+    state, root_hp, operator_group_dict, level, prune_mass, threshold, mixture = args
+    node = solver_node(state, root_hp, operator_group_dict, None, None, level=level, prune_mass=prune_mass, threshold=threshold,
+                       mixture=mixture)
+    node.get_score()
+    return node.score, node.best_children_group
+
 class Solver:
-    def __init__(self, initial_state, operator_group_list):
+    def __init__(self, initial_state, operator_group_list, prune_mass=0, objective='expectation', threshold=None):
+        '''
+        prune_mass: pruned search, at every node the least likely child states covering
+        up to prune_mass of the probability are dropped. Not exact.
+        objective: 'expectation' maximizes the expected damage, 'kill' the kill probability
+        at threshold (28 - hp by default). The kill search stops at the states that already
+        killed or can't kill anymore
+        initial_state: a GameState, or a weighted list of GameStates with the same hp, see
+        ProbabilityTree.mixture_roots. The first group is then chosen for the mixture, the
+        later ones for the states reached
+        '''
+        if objective not in ('expectation', 'kill'):
+            raise ValueError(f"Invalid objective: {objective}")
+        self.initial_state = initial_state
+        self.roots = mixture_roots(initial_state)
+        self.objective = objective
+        self.threshold = None
+        if objective == 'kill':
+            self.threshold = 28 - self.roots[0].hp() if threshold is None else threshold
+        self.prune_mass = prune_mass
+        self.engine = None
         self.operator_group_list = operator_group_list
         self.operator_group_dict = {}
         for ops in operator_group_list:
             self.operator_group_dict[ops] = self.operator_group_dict.get(ops, 0) + 1
         for ops, times in self.operator_group_dict.items():
             print(f"Operator {ops}: {times}")
-        self.root = solver_node(initial_state, initial_state.hp(), self.operator_group_dict, None, None, level=0)
+        self.root = self.new_root(prune_mass)
+    
+    def new_root(self, prune_mass):
+        mixture = self.roots if len(self.roots) > 1 else None
+        return solver_node(self.roots[0], self.roots[0].hp(), self.operator_group_dict, None, None, level=0,
+                           prune_mass=prune_mass, threshold=self.threshold, mixture=mixture)
     
     def solve(self):
         return self.root.get_score()
     
+    def get_frontier(self, min_tasks):
+        '''
+        Expand the tree from the root, one level at a time, until there are at least
+        min_tasks nodes left to score or nothing left to expand
+        Return: list of the nodes to score, in the order of the serial search
+        '''
+        frontier = [self.root]
+        while True:
+            nodes = [node for node in frontier if not node.is_leaf() and node.score is None]
+            if not nodes or len(nodes) >= min_tasks:
+                return nodes
+            frontier = []
+            for node in nodes:
+                node.build_children()
+                for children in node.children_groups:
+                    frontier.extend(children)
+    
+    def solve_parallel(self, workers=None, min_tasks=None):
+        '''
+        Same result as solve, the subtrees of the frontier nodes are scored in a process pool.
+        The nodes above the frontier pick their best group in the same order as solve,
+        so the ties and the policy are the same
+        workers: number of processes, all the cores by default
+        min_tasks: number of subtrees to hand out, 4 per worker by default, the frontier goes
+        deeper than the first move when the root has fewer choices
+        '''
+        if workers is None:
+            workers = os.cpu_count() or 1
+        if workers <= 1:
+            return self.solve()
+        if min_tasks is None:
+            min_tasks = workers * 4
+        
+        nodes = self.get_frontier(min_tasks)
+        if nodes:
+            tasks = [(node.state, node.root_hp, node.operator_group_dict, node.level, node.prune_mass, node.threshold, node.mixture)
+                     for node in nodes]
+            with ProcessPoolExecutor(max_workers=workers, initializer=load_effects, initargs=(effect_definitions(),)) as executor:
+                results = executor.map(solve_subtree, tasks, chunksize=max(1, len(tasks) // (workers * 4)))
+                for node, (score, best_children_group) in zip(nodes, results):
+                    node.score = score
+                    node.best_children_group = best_children_group
+                    if best_children_group is not None:
+                        for child in best_children_group:
+                            child.parent = node
+        return self.root.get_score()
+    
+    def estimate(self, probe_states=5000, num_samples=200):
+        '''
+        Predict the number of search nodes and the runtime of solve.
+        The states after k groups are estimated with ProbabilityTree.estimate on the
+        operator list in the given order, times the number of distinct group orders.
+        Return: dict(nodes, time)
+        '''
+        operator_list = [op for ops in self.operator_group_list for op in ops]
+        estimate = ProbabilityTree(self.initial_state, operator_list).estimate(probe_states, num_samples)
+        layer_sizes = [1] + estimate['layer_sizes']
+        group_counts = tuple(self.operator_group_dict.values())
+        
+        nodes = 0
+        expansions = 0
+        op_index = 0
+        for k, ops in enumerate(self.operator_group_list):
+            orders = count_prefixes(group_counts, k)
+            nodes += orders * layer_sizes[min(op_index, len(layer_sizes) - 1)]
+            # Every node runs each remaining distinct group
+            expansions += orders * layer_sizes[min(op_index, len(layer_sizes) - 1)] * len(ops) * len(group_counts)
+            op_index += len(ops)
+        return {'nodes': nodes, 'time': estimate['state_time'] * expansions}
+    
+    def solve_auto(self, time_budget=10, memory_budget=2000000, prune_mass=0.01):
+        '''
+        Exact search if the estimate fits in time_budget seconds and memory_budget nodes,
+        pruned search otherwise. Sampling is not offered, the optimal policy needs a value
+        for every reachable state.
+        Return: (score, engine name), the engine is also kept in self.engine
+        '''
+        estimate = self.estimate()
+        if estimate['time'] <= time_budget and estimate['nodes'] <= memory_budget:
+            self.engine = 'exact'
+        else:
+            self.engine = 'pruned'
+            self.prune_mass = prune_mass
+            self.root = self.new_root(prune_mass)
+        return self.solve(), self.engine
+    
     def show(self):
         # Show the best strategy
+        # The graph and plotting libraries are slow to import, only load them here
+        import networkx as nx
+        import matplotlib.pyplot as plt
+        from networkx.drawing.nx_agraph import graphviz_layout
+        
         node = self.root
         queue = [node]
         
@@ -95,7 +294,7 @@ class Solver:
             node = queue.pop(0)
             
             if node.level != len(self.operator_group_list):
-                G.add_node(node_id, label=str(node.state))
+                G.add_node(node_id, label='\n'.join(str(state) for state in node.leaf_states()))
                 node.id = node_id
                 
                 if not node.is_root():
@@ -135,12 +334,25 @@ class Solver:
         queue = [node]
         result = {}
         init_hp = node.root_hp
+        # (start state, remaining operators): distribution, absorbed leaves often share their continuation
+        continuations = {}
         
         while queue:
             node = queue.pop(0)
-            if node.is_leaf():
-                damage = node.state.hp() - init_hp
-                result[damage] = result.get(damage, 0) + node.state.probability
+            if node.is_leaf() and node.operator_group_dict and node.is_absorbed() and not node.state.is_terminal():
+                # The kill is decided, the remaining groups are played in the given order
+                operator_list = [op for ops, times in node.operator_group_dict.items() for _ in range(times) for op in ops]
+                start = GameState(node.state.player.copy(), node.state.atk_player.copy(), 1)
+                dealt = node.state.hp() - init_hp
+                key = (start, tuple(operator_list))
+                if key not in continuations:
+                    continuations[key] = ProbabilityTree(start, operator_list).get_distribution()
+                for damage, prob in continuations[key].as_dict().items():
+                    result[dealt + damage] = result.get(dealt + damage, 0) + node.state.probability * prob
+            elif node.is_leaf():
+                for state in node.leaf_states():
+                    damage = state.hp() - init_hp
+                    result[damage] = result.get(damage, 0) + state.probability
             else:
                 queue.extend(node.best_children_group)
 
@@ -152,4 +364,178 @@ class Solver:
         check = sum(prob for prob in result.values())
         if check != 1:
             print(f"Error: Probability sum is not 1, sum is {check}")
-        return result, kill_prob, expecated_damage, variance
\ No newline at end of file
+        return result, kill_prob, expecated_damage, variance
+
+class SequenceRanker:
+    def __init__(self, initial_state, operator_group_list, threshold=None, objective='expectation', lump=True,
+                 suffix_table=None, backward_groups=2):
+        '''
+        Rank the fixed orderings of the operator groups, unlike Solver the order is chosen
+        before the attack and doesn't depend on the outcomes
+        objective: 'expectation' or 'kill', the kill probability at threshold (28 - hp by default)
+        initial_state: a GameState or a weighted list of GameStates, see ProbabilityTree.mixture_roots
+        The orderings are expanded as a prefix tree, so orderings sharing a prefix share its layers.
+        Once only backward_groups groups remain, every completion of the prefix is evaluated
+        backward with suffix_table (see ProbabilityTree.calculate_backward), the short suffixes
+        are shared by all prefixes, which is cheaper than expanding the last layers forward
+        '''
+        if objective not in ('expectation', 'kill'):
+            raise ValueError(f"Invalid objective: {objective}")
+        self.roots = mixture_roots(initial_state)
+        self.root_hp = self.roots[0].hp()
+        self.threshold = 28 - self.root_hp if threshold is None else threshold
+        self.objective = objective
+        self.lump = lump
+        self.suffix_table = suffix_table if suffix_table is not None else SuffixTable(max_entries=float('inf'))
+        self.backward_groups = backward_groups
+        group_dict = {}
+        for ops in operator_group_list:
+            group_dict[tuple(ops)] = group_dict.get(tuple(ops), 0) + 1
+        self.groups = list(group_dict)
+        self.group_counts = tuple(group_dict.values())
+        # (max damage, max cards, has trigger) of every group
+        self.group_bounds = [(sum(max_damage(op) for op in ops), sum(max_cards(op) for op in ops),
+                              any(op[0] == Operator.TRIGGER for op in ops)) for ops in self.groups]
+        self.total = count_prefixes(self.group_counts, sum(self.group_counts))
+        self.evaluated = 0
+        self.skipped = 0
+    
+    def remaining_bounds(self, counts):
+        damage = sum(bound[0] * times for bound, times in zip(self.group_bounds, counts))
+        cards = sum(bound[1] * times for bound, times in zip(self.group_bounds, counts))
+        trigger = any(bound[2] for bound, times in zip(self.group_bounds, counts) if times > 0)
+        return damage, cards, trigger
+    
+    def expand(self, layer, finished, group_index, counts):
+        '''
+        Apply a group to every state of layer
+        counts: the groups left after this one
+        Return: (next layer, finished damages), the terminal states and, after the last group,
+        every state are moved to the finished damages
+        '''
+        finished = dict(finished)
+        _, cards, trigger = self.remaining_bounds(counts)
+        is_last = sum(counts) == 0
+        ops = self.groups[group_index]
+        for i, op in enumerate(ops):
+            # Signature of the operators after op, for lumping
+            remaining_cards = cards + sum(max_cards(rest) for rest in ops[i + 1:])
+            remaining_trigger = trigger or any(rest[0] == Operator.TRIGGER for rest in ops[i + 1:])
+            next_layer = {}
+            for state in layer.values():
+                for new_state in state.execute(op):
+                    if new_state.is_terminal() or (is_last and i == len(ops) - 1):
+                        damage = new_state.hp() - self.root_hp
+                        finished[damage] = finished.get(damage, 0) + new_state.probability
+                        continue
+                    if self.lump:
+                        new_state = ProbabilityTree.lump_to(new_state, remaining_cards, remaining_trigger)
+                    if new_state in next_layer:
+                        next_layer[new_state].add_probability(new_state.probability)
+                    else:
+                        next_layer[new_state] = new_state
+            layer = next_layer
+        return layer, finished
+    
+    def score(self, distribution):
+        if self.objective == 'kill':
+            return distribution.kill_probability(self.threshold)
+        return distribution.expectation
+    
+    def upper_bound(self, layer, finished, counts):
+        '''
+        Best score any ordering starting with this prefix can reach: the unfinished states
+        are given the most damage the remaining groups can deal
+        '''
+        damage, cards, _ = self.remaining_bounds(counts)
+        if self.objective == 'kill':
+            bound = sum(prob for dealt, prob in finished.items() if dealt >= self.threshold)
+            for state in layer.values():
+                if state.hp() - self.root_hp + ProbabilityTree.damage_bound(state, damage, cards) >= self.threshold:
+                    bound += state.probability
+            return bound
+        bound = sum(dealt * prob for dealt, prob in finished.items())
+        for state in layer.values():
+            bound += (state.hp() - self.root_hp + ProbabilityTree.damage_bound(state, damage, cards)) * state.probability
+        return bound
+    
+    def orderings(self, counts):
+        '''
+        Every distinct ordering of the groups left in counts
+        '''
+        if sum(counts) == 0:
+            yield ()
+            return
+        for i, times in enumerate(counts):
+            if times == 0:
+                continue
+            rest = list(counts)
+            rest[i] -= 1
+            for ordering in self.orderings(tuple(rest)):
+                yield (self.groups[i],) + ordering
+    
+    def complete(self, layer, finished, ordering):
+        '''
+        Damage distribution of the prefix followed by ordering, evaluated backward from every state of layer
+        '''
+        tree = ProbabilityTree(self.roots[0], [op for ops in ordering for op in ops], lump=self.lump, suffix_table=self.suffix_table)
+        result = dict(finished)
+        for state in layer.values():
+            dealt = state.hp() - self.root_hp
+            for damage, prob in tree.suffix_distribution(state).items():
+                result[dealt + damage] = result.get(dealt + damage, 0) + state.probability * prob
+        return DamageDistribution(result)
+    
+    def rank(self, k=3):
+        '''
+        Return: the k best orderings, list of (tuple of operator groups, DamageDistribution),
+        best first. Prefixes whose upper bound is below the k-th best ordering found so far
+        are dropped, the number of orderings dropped is kept in skipped and the number
+        fully evaluated in evaluated
+        '''
+        self.evaluated = 0
+        self.skipped = 0
+        # Min heap of (score, order found, sequence, distribution), the k best so far
+        top = []
+        
+        def submit(sequence, distribution):
+            self.evaluated += 1
+            entry = (self.score(distribution), -self.evaluated, sequence, distribution)
+            if len(top) < k:
+                heapq.heappush(top, entry)
+            elif entry[0] > top[0][0]:
+                heapq.heapreplace(top, entry)
+        
+        def visit(sequence, layer, finished, counts):
+            if sum(counts) == 0 or not layer:
+                if sum(counts) > 0:
+                    # Every state is terminal, the remaining groups don't change the damage
+                    sequence = sequence + next(self.orderings(counts))
+                    self.skipped += count_prefixes(counts, sum(counts)) - 1
+                submit(sequence, DamageDistribution(finished))
+                return
+            if sum(counts) <= self.backward_groups:
+                for ordering in self.orderings(counts):
+                    submit(sequence + ordering, self.complete(layer, finished, ordering))
+                return
+            
+            children = []
+            for i, times in enumerate(counts):
+                if times == 0:
+                    continue
+                rest = list(counts)
+                rest[i] -= 1
+                rest = tuple(rest)
+                next_layer, next_finished = self.expand(layer, finished, i, rest)
+                children.append((self.upper_bound(next_layer, next_finished, rest), i, next_layer, next_finished, rest))
+            # Most promising first, the k-th best rises quickly and cuts more
+            children.sort(key=lambda child: (-child[0], child[1]))
+            for bound, i, next_layer, next_finished, rest in children:
+                if len(top) == k and bound <= top[0][0]:
+                    self.skipped += count_prefixes(rest, sum(rest))
+                    continue
+                visit(sequence + (self.groups[i],), next_layer, next_finished, rest)
+        
+        visit((), {root: GameState(root.player.copy(), root.atk_player.copy(), root.probability) for root in self.roots},
+              {}, self.group_counts)
+        return [(sequence, distribution) for _, _, sequence, distribution in sorted(top, reverse=True)]
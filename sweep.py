@@ -0,0 +1,405 @@
+# 批量参数扫描：在卡组/攻击方参数网格上计算斩杀率、期望和方差
+import itertools
+import json
+import math
+import os
+import socket
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+from GameState import Player, atkPlayer, GameState
+from ProbabilityTree import ProbabilityTree
+from utils import Operator, parse_operator_list, effect_definitions, load_effects
+
+AXES = ('deck', 'deck_climax', 'waiting_room', 'waiting_room_climax', 'hp', 'atk', 'atk_soul', 'operator_list')
+DEFAULTS = {
+    'deck': 50,
+    'deck_climax': 8,
+    'waiting_room': 0,
+    'waiting_room_climax': 0,
+    'hp': 0,
+    'atk': 50,
+    'atk_soul': 15,
+}
+# Seconds between two touches of the claim of a running shard, stale_after must be a few of them
+HEARTBEAT = 5
+# Seconds without heartbeat after which the claim of a worker on another machine is taken over
+STALE_AFTER = 60
+
+class SweepResult:
+    def __init__(self, axes):
+        '''
+        axes: list of (name, values), in the order of the grid dimensions
+        kill_prob, expectation, variance: float arrays of the grid shape, NaN until the point is done
+        or if the point is not a valid scene
+        '''
+        self.axes = axes
+        shape = tuple(len(values) for _, values in axes)
+        self.kill_prob = np.full(shape, np.nan)
+        self.expectation = np.full(shape, np.nan)
+        self.variance = np.full(shape, np.nan)
+        self.done = np.zeros(shape, dtype=bool)
+
+    def set_point(self, index, kill_prob, expectation, variance):
+        self.kill_prob[index] = kill_prob
+        self.expectation[index] = expectation
+        self.variance[index] = variance
+        self.done[index] = True
+
+    def is_complete(self):
+        return bool(self.done.all())
+
+def evaluate_point(params, threshold=None):
+    '''
+    params: dict with every name of AXES, operator_list is a string
+    threshold: damage needed to kill, 28 - hp by default
+    Return: (kill probability, expectation, variance) as floats, NaN if the scene is not valid
+    '''
+    if params['deck_climax'] > params['deck'] or params['waiting_room_climax'] > params['waiting_room'] or \
+       params['atk_soul'] > params['atk'] or not 0 <= params['hp'] < 28:
+        return math.nan, math.nan, math.nan
+
+    hp = params['hp']
+    initial_player = Player((params['deck'], params['deck_climax']),
+                            (params['waiting_room'], params['waiting_room_climax']),
+                            (hp // 7, 0), (hp % 7, 0))
+    initial_state = GameState(initial_player, atkPlayer((params['atk'], params['atk_soul'])), 1)
+    operator_list = parse_operator_list(params['operator_list'])
+    if threshold is None:
+        threshold = 28 - hp
+    _, kill_prob, expectation, variance = ProbabilityTree(initial_state, operator_list).calculate_probabilities(threshold)
+    return float(kill_prob), float(expectation), float(variance)
+
+def evaluate_points(points, threshold=None):
+    '''
+    Worker entry, the transition caches of the process are shared by all its points
+    points: list of (grid index, params)
+    '''
+    return [(index, *evaluate_point(params, threshold)) for index, params in points]
+
+def grid_points(grid):
+    '''
+    grid: dict(axis name: list of values), missing axes use DEFAULTS, operator_list is required
+    Return: (axes, list of (grid index, params)), the points are in grid order
+    '''
+    for name in grid:
+        if name not in AXES:
+            raise ValueError(f"Invalid sweep axis: {name}")
+    if 'operator_list' not in grid:
+        raise ValueError("The sweep needs at least one operator list")
+
+    axes = [(name, list(grid[name])) for name in AXES if name in grid]
+    points = []
+    for index in itertools.product(*[range(len(values)) for _, values in axes]):
+        params = dict(DEFAULTS)
+        for (name, values), i in zip(axes, index):
+            params[name] = values[i]
+        points.append((index, params))
+    return axes, points
+
+def iter_sweep(grid, threshold=None, workers=1, chunk_size=None):
+    '''
+    Evaluate every point of the grid, yield the SweepResult each time a chunk of points is done
+    grid: dict(axis name: list of values), missing axes use DEFAULTS, operator_list is required
+    workers: number of processes, 1 evaluates in this process
+    chunk_size: number of neighbouring points given to a worker at once, neighbouring
+    points differ only in the last axes, so they reuse the same transitions
+    '''
+    axes, points = grid_points(grid)
+    result = SweepResult(axes)
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if chunk_size is None:
+        chunk_size = max(1, math.ceil(len(points) / (workers * 4)))
+    chunks = [points[i:i + chunk_size] for i in range(0, len(points), chunk_size)]
+
+    if workers == 1:
+        for chunk in chunks:
+            for index, kill_prob, expectation, variance in evaluate_points(chunk, threshold):
+                result.set_point(index, kill_prob, expectation, variance)
+            yield result
+        return
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=load_effects, initargs=(effect_definitions(),)) as executor:
+        futures = [executor.submit(evaluate_points, chunk, threshold) for chunk in chunks]
+        for future in as_completed(futures):
+            for index, kill_prob, expectation, variance in future.result():
+                result.set_point(index, kill_prob, expectation, variance)
+            yield result
+
+def sweep(grid, threshold=None, workers=1, chunk_size=None, callback=None):
+    '''
+    Same as iter_sweep, but return the complete SweepResult
+    callback: optional function called with the partial SweepResult after every chunk
+    Example:
+        sweep({'deck': range(20, 41), 'deck_climax': range(6, 11), 'atk_soul': range(12, 19),
+               'operator_list': ['3t 3t 3t']}, workers=4)
+    '''
+    result = None
+    for result in iter_sweep(grid, threshold, workers, chunk_size):
+        if callback is not None:
+            callback(result)
+    return result
+
+class ShardedSweep:
+    def __init__(self, directory, grid=None, threshold=None, shard_size=100):
+        '''
+        A sweep split into shards of shard_size points, run by any number of processes or
+        machines sharing directory. Every finished shard is saved to its own file, so a
+        sweep that dies only loses the shards in progress, and running it again resumes.
+        directory: holds manifest.json (the grid and the steps of the effects it uses), shard_N.claim (a worker took the shard)
+        and shard_N.json (the results of the shard)
+        grid, threshold, shard_size: see iter_sweep. A new sweep needs the grid, an existing
+        one is opened from its manifest and must not be given a different grid
+        '''
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        manifest_path = os.path.join(directory, 'manifest.json')
+        manifest = None
+        if grid is not None:
+            manifest = {
+                'grid': {name: list(values) for name, values in grid.items()},
+                'threshold': threshold,
+                'shard_size': shard_size,
+            }
+            # The workers on other machines don't have the effects declared here
+            effects = set(operator[1][0] for operator_list in grid['operator_list']
+                          for operator in parse_operator_list(operator_list) if operator[0] == Operator.EFFECT)
+            if effects:
+                manifest['effects'] = effect_definitions(sorted(effects))
+
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                saved = json.load(f)
+            if manifest is not None and saved != manifest:
+                raise ValueError(f"{directory} holds a different sweep")
+            manifest = saved
+        elif manifest is None:
+            raise ValueError(f"No sweep in {directory}, a grid is needed to start one")
+        else:
+            write_json(manifest_path, manifest)
+
+        load_effects(manifest.get('effects', {}))
+        self.grid = manifest['grid']
+        self.threshold = manifest['threshold']
+        self.shard_size = manifest['shard_size']
+        self.axes, self.points = grid_points(self.grid)
+        self.shard_num = math.ceil(len(self.points) / self.shard_size)
+        # shard: content of the claim file written by this worker
+        self.tokens = {}
+
+    def shard_path(self, shard, suffix):
+        return os.path.join(self.directory, f'shard_{shard:05d}.{suffix}')
+
+    def is_done(self, shard):
+        return os.path.exists(self.shard_path(shard, 'json'))
+
+    def progress(self):
+        '''
+        Return: (number of finished shards, number of shards)
+        '''
+        return sum(1 for shard in range(self.shard_num) if self.is_done(shard)), self.shard_num
+
+    def claim(self, shard, stale_after=STALE_AFTER):
+        '''
+        Take a shard, the claim file is created with O_EXCL so only one worker gets it,
+        also on a shared directory
+        stale_after: seconds without heartbeat after which the claim of a worker that died
+        is taken over, see run_shard. None to only take over the claims of dead local processes
+        Return: whether this worker owns the shard
+        '''
+        path = self.shard_path(shard, 'claim')
+        if os.path.exists(path) and not self.is_done(shard):
+            self.take_over(shard, stale_after)
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        token = f"{socket.gethostname()} {os.getpid()} {time.time()}\n"
+        with os.fdopen(fd, 'w') as f:
+            f.write(token)
+        self.tokens[shard] = token
+        return True
+
+    def take_over(self, shard, stale_after):
+        '''
+        Remove the claim of shard if its worker is dead, see is_stale. The claim is moved away before
+        it is checked again, a claim that another worker has just renewed or re-created is put back
+        '''
+        path = self.shard_path(shard, 'claim')
+        try:
+            with open(path) as f:
+                stale_token = f.read()
+            if not is_stale(stale_token, os.path.getmtime(path), stale_after):
+                return
+            moved_path = f'{path}.{socket.gethostname()}.{os.getpid()}.stale'
+            os.rename(path, moved_path)
+        except FileNotFoundError:
+            return
+        with open(moved_path) as f:
+            token = f.read()
+        if token == stale_token and is_stale(token, os.path.getmtime(moved_path), stale_after):
+            os.remove(moved_path)
+            return
+        try:
+            # link fails if the claim exists again, then that one is kept
+            os.link(moved_path, path)
+        except FileExistsError:
+            pass
+        os.remove(moved_path)
+
+    def release(self, shard):
+        '''
+        Remove the claim of shard if this worker still owns it
+        '''
+        path = self.shard_path(shard, 'claim')
+        token = self.tokens.pop(shard, None)
+        try:
+            with open(path) as f:
+                if f.read() != token:
+                    return
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def heartbeat(self, shard, stop):
+        # Touch the claim until the shard is over, a claim that keeps its mtime fresh is not taken over
+        while not stop.wait(HEARTBEAT):
+            try:
+                os.utime(self.shard_path(shard, 'claim'))
+            except FileNotFoundError:
+                pass
+
+    def run_shard(self, shard):
+        '''
+        Evaluate a claimed shard, a thread keeps the claim alive even while a single point
+        takes long. The claim is released also if the shard fails, another worker retries it
+        '''
+        points = self.points[shard * self.shard_size:(shard + 1) * self.shard_size]
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=self.heartbeat, args=(shard, stop), daemon=True)
+        heartbeat.start()
+        try:
+            rows = []
+            for index, *values in evaluate_points(points, self.threshold):
+                # NaN is not valid JSON, the invalid scenes are saved as null
+                rows.append([list(index)] + [None if math.isnan(value) else value for value in values])
+            write_json(self.shard_path(shard, 'json'), rows)
+        finally:
+            stop.set()
+            heartbeat.join()
+            self.release(shard)
+
+    def run(self, stale_after=STALE_AFTER, callback=None):
+        '''
+        Work on the shards until none is left to claim, the finished ones are skipped
+        callback: optional function called with progress() after every shard
+        Return: number of shards run by this worker
+        '''
+        if stale_after is not None and stale_after < 3 * HEARTBEAT:
+            raise ValueError(f"stale_after must be at least {3 * HEARTBEAT} seconds, three heartbeats")
+        done = 0
+        for shard in range(self.shard_num):
+            if self.is_done(shard) or not self.claim(shard, stale_after):
+                continue
+            if self.is_done(shard):
+                # Finished by another worker between the check and the claim
+                self.release(shard)
+                continue
+            self.run_shard(shard)
+            done += 1
+            if callback is not None:
+                callback(self.progress())
+        return done
+
+    def run_parallel(self, workers=None, stale_after=STALE_AFTER):
+        '''
+        Run the shards with several local processes
+        Return: number of shards run
+        '''
+        if workers is None:
+            workers = os.cpu_count() or 1
+        with ProcessPoolExecutor(max_workers=workers, initializer=load_effects, initargs=(effect_definitions(),)) as executor:
+            futures = [executor.submit(run_sharded_worker, self.directory, stale_after) for _ in range(workers)]
+            return sum(future.result() for future in futures)
+
+    def merge(self):
+        '''
+        Collect the finished shards into one SweepResult, the points of missing shards stay NaN
+        '''
+        result = SweepResult(self.axes)
+        for shard in range(self.shard_num):
+            if not self.is_done(shard):
+                continue
+            with open(self.shard_path(shard, 'json')) as f:
+                for index, *values in json.load(f):
+                    result.set_point(tuple(index), *[math.nan if value is None else value for value in values])
+        return result
+
+def write_json(path, data):
+    # Write to a temporary file first, a crash never leaves a half written file
+    tmp_path = f'{path}.{socket.gethostname()}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def process_alive(pid):
+    '''
+    Whether a process of this machine is running. Only checked on POSIX, os.kill would
+    terminate the process on Windows, there it is assumed alive
+    '''
+    if os.name != 'posix':
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+def is_stale(token, mtime, stale_after):
+    '''
+    Whether the worker of a claim is dead: no heartbeat for stale_after seconds, or the
+    claim comes from a process of this machine that is not running anymore
+    token: content of the claim file, "hostname pid time"
+    '''
+    if stale_after is not None and time.time() - mtime > stale_after:
+        return True
+    parts = token.split()
+    if len(parts) != 3 or not parts[1].isdigit():
+        # A worker writes its token right after creating the claim
+        return time.time() - mtime > HEARTBEAT
+    if parts[0] != socket.gethostname():
+        return False
+    pid = int(parts[1])
+    return pid != os.getpid() and not process_alive(pid)
+
+def run_sharded_worker(directory, stale_after=STALE_AFTER):
+    return ShardedSweep(directory).run(stale_after)
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Run or merge the shards of a sweep started with ShardedSweep")
+    parser.add_argument('directory')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--stale-after', type=float, default=STALE_AFTER,
+                        help="seconds without heartbeat after which the shard of a worker on another machine is taken over")
+    parser.add_argument('--merge', action='store_true', help="don't run any shard, only merge the finished ones")
+    args = parser.parse_args()
+
+    sharded = ShardedSweep(args.directory)
+    if not args.merge:
+        if args.workers > 1:
+            sharded.run_parallel(args.workers, args.stale_after)
+        else:
+            sharded.run(args.stale_after, callback=lambda progress: print(f"{progress[0]}/{progress[1]} shards"))
+    done, total = sharded.progress()
+    print(f"{done}/{total} shards done")
+    result = sharded.merge()
+    np.savez(os.path.join(args.directory, 'result.npz'), kill_prob=result.kill_prob,
+             expectation=result.expectation, variance=result.variance, done=result.done)
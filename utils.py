@@ -7,6 +7,7 @@ class Operator(Enum):
     WOODY = 3
     DAMAGE = 4
     TRIGGER = 5
+    EFFECT = 6
     
     def __str__(self):
         if self == Operator.MOKA:
@@ -19,15 +20,122 @@ class Operator(Enum):
             return "Damage"
         elif self == Operator.TRIGGER:
             return "Trigger"
+        elif self == Operator.EFFECT:
+            return "Effect"
         else:
             raise ValueError(f"Invalid operator: {self}")
         
+# Primitives of the declarative effects, see define_effect
+EFFECT_PRIMITIVES = ('look', 'mill', 'mill_bottom', 'clock', 'damage', 'shuffle')
+# Primitives that count the climax cards they reveal
+COUNTING_PRIMITIVES = ('look', 'mill', 'mill_bottom')
+BUILTIN_OPERATORS = ('moka', 'michiru', 'woody')
+# name: tuple of steps
+EFFECTS = {}
+
+def define_effect(name, steps):
+    '''
+    Declare a new operator, used as name(N) in the operator list.
+    steps: list of (primitive, amount), the amount is an integer, 'n' for the N of the
+    operator, or 'climax' for the number of climax cards counted by the last look/mill
+        look: reveal the top cards and count the climaxes, the state doesn't keep the order of the
+              looked cards, so a shuffle must follow before the top of the deck is used again
+        mill: put the top cards into the waiting room, count the climaxes
+        mill_bottom: put the bottom cards into the waiting room, count the climaxes
+        clock: put the top cards to the clock
+        damage: damage that can be cancelled
+        shuffle: shuffle the deck, no amount
+    Example, woody written as an effect: define_effect('reveal_clock', [('look', 'n'), ('shuffle',), ('clock', 'climax')])
+    '''
+    name = name.lower()
+    if not re.fullmatch(r'[a-z_][a-z0-9_]*', name) or name in BUILTIN_OPERATORS:
+        raise ValueError(f"Invalid effect name: {name}")
+    
+    counted = False
+    # The looked cards are on top until the next shuffle
+    looked = False
+    checked_steps = []
+    for step in steps:
+        primitive, amount = step[0], step[1:]
+        if primitive not in EFFECT_PRIMITIVES:
+            raise ValueError(f"Invalid effect primitive: {primitive}")
+        if primitive == 'shuffle':
+            if amount:
+                raise ValueError("Shuffle has no amount")
+            checked_steps.append(('shuffle',))
+            looked = False
+            continue
+        if len(amount) != 1:
+            raise ValueError(f"{primitive} needs one amount")
+        amount = amount[0]
+        if amount == 'climax' and not counted:
+            raise ValueError(f"{primitive} uses the climax count before any look or mill")
+        if amount not in ('n', 'climax') and not (isinstance(amount, int) and amount >= 0):
+            raise ValueError(f"Invalid amount of {primitive}: {amount}")
+        if looked and primitive != 'mill_bottom':
+            raise ValueError(f"{primitive} after a look uses the looked cards, add a shuffle before it")
+        looked = looked or primitive == 'look'
+        counted = counted or primitive in COUNTING_PRIMITIVES
+        checked_steps.append((primitive, amount))
+    if looked:
+        raise ValueError("The looked cards must be shuffled before the end of the effect")
+    EFFECTS[name] = tuple(checked_steps)
+
+def effect_definitions(names=None):
+    '''
+    Steps of the declared effects, all of them or only names. EFFECTS only lives in this
+    process, the workers of a process pool started with spawn get it through load_effects
+    Return: dict(name: list of steps), steps as lists so that it can be saved as JSON
+    '''
+    if names is None:
+        names = EFFECTS
+    return {name: [list(step) for step in EFFECTS[name]] for name in names}
+
+def load_effects(effects):
+    '''
+    Declare the effects of effect_definitions, also the initializer of the process pools
+    '''
+    for name, steps in effects.items():
+        EFFECTS[name] = tuple(tuple(step) for step in steps)
+
+def compile_effect(operator):
+    '''
+    Steps of an effect operator with the amounts bound to N
+    Return: tuple of (primitive, amount), the amount is an integer or 'climax'
+    '''
+    name, num = operator[1]
+    if name not in EFFECTS:
+        raise ValueError(f"Unknown effect: {name}")
+    return tuple(step if len(step) == 1 or step[1] != 'n' else (step[0], num) for step in EFFECTS[name])
+
+def effect_bounds(operator):
+    '''
+    Upper bounds of the cards taken from the deck and of the damage of an effect operator
+    '''
+    cards = 0
+    damage = 0
+    counted = 0
+    for step in compile_effect(operator):
+        if step[0] == 'shuffle':
+            continue
+        primitive, amount = step
+        if amount == 'climax':
+            amount = counted
+        if primitive in COUNTING_PRIMITIVES:
+            counted = amount
+        if primitive in ('mill', 'mill_bottom', 'clock', 'damage'):
+            cards += amount
+        if primitive in ('clock', 'damage'):
+            damage += amount
+    return cards, damage
+
 def parse_operator(operator):
         """解析操作符，调用对应的函数"""
         operator = operator.lower()  # 转换为小写以处理大小写不敏感的问题
         moka_match = re.match(r'moka\((\d+)\)', operator)
         michiru_match = re.match(r'michiru\((\d+)\)', operator)
         woody_match = re.match(r'woody\((\d+)\)', operator)
+        effect_match = re.fullmatch(r'([a-z_][a-z0-9_]*)\((\d+)\)', operator)
         damage_trigger_match = re.match(r'(\d+)t', operator)
         damage_match = re.match(r'(\d+)', operator)
         
@@ -40,6 +148,8 @@ def parse_operator(operator):
         elif woody_match:
             num = int(woody_match.group(1))
             return (Operator.WOODY, num)
+        elif effect_match and effect_match.group(1) in EFFECTS:
+            return (Operator.EFFECT, (effect_match.group(1), int(effect_match.group(2))))
         elif damage_trigger_match:
             damage = int(damage_trigger_match.group(1))
             return (Operator.TRIGGER, damage)
@@ -49,6 +159,39 @@ def parse_operator(operator):
         else:
             raise ValueError(f"Invalid operator: {operator}")
 
+def max_cards(operator):
+    '''
+    Upper bound of the number of cards the operator takes from the deck, refresh penalty excluded
+    '''
+    operator_type, num = operator
+    if operator_type == Operator.MICHIRU:
+        # The milled cards, then a damage check of up to num cards
+        return 2 * num
+    elif operator_type == Operator.TRIGGER:
+        return num + 1
+    elif operator_type in (Operator.MOKA, Operator.WOODY, Operator.DAMAGE):
+        return num
+    elif operator_type == Operator.EFFECT:
+        return effect_bounds(operator)[0]
+    else:
+        raise ValueError(f"Invalid operator: {operator}")
+
+def max_damage(operator):
+    '''
+    Upper bound of the damage dealt by the operator, refresh penalty excluded
+    '''
+    operator_type, num = operator
+    if operator_type == Operator.MOKA:
+        return 0
+    elif operator_type == Operator.TRIGGER:
+        return num + 1
+    elif operator_type in (Operator.MICHIRU, Operator.WOODY, Operator.DAMAGE):
+        return num
+    elif operator_type == Operator.EFFECT:
+        return effect_bounds(operator)[1]
+    else:
+        raise ValueError(f"Invalid operator: {operator}")
+
 def to_str(operator):
     if operator[0] == Operator.MOKA:
         return f"Moka({operator[1]})"
@@ -60,9 +203,20 @@ def to_str(operator):
         return f"{operator[1]}"
     elif operator[0] == Operator.TRIGGER:
         return f"{operator[1]}T"
+    elif operator[0] == Operator.EFFECT:
+        return f"{operator[1][0]}({operator[1][1]})"
     else:
         raise ValueError(f"Invalid operator: {operator}")
 
+def cache_str(operator):
+    '''
+    to_str of the operator, with the steps of an effect, a redefined effect gets another
+    string, used in the keys of the results saved on disk
+    '''
+    if operator[0] == Operator.EFFECT:
+        return f"{to_str(operator)}{list(compile_effect(operator))}"
+    return to_str(operator)
+
 def to_str_group(operator_group):
     '''
     Convert the operator group to a string
@@ -80,6 +234,14 @@ def parse_operator_group(operator_group):
         operator_list.append((operator, times))
     return tuple(operator_list)
 
+def parse_operator_list(operator_list):
+    '''
+    Parse a space separated list of operator groups, like the GUI input box
+    Return: flat list of operators
+    '''
+    operator_groups = [parse_operator_group(op.strip()) for op in operator_list.split(' ') if op.strip()]
+    return [operator for operator_group in operator_groups for operator in operator_group]
+
 def find_max_repeated_sublist(lst):
     n = len(lst)
     # 找出n的所有因子